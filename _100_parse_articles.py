@@ -4,14 +4,38 @@
 field-wise lists of articles with multiaffiliations for specific countries.
 """
 
+import csv
+import json
+import os
+import shutil
+import sqlite3
+import zlib
+from argparse import ArgumentParser
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from configparser import ConfigParser
+from contextlib import contextmanager
 from glob import glob
-from math import ceil
+from hashlib import sha1
+from itertools import islice
 from os.path import basename, splitext
+from threading import Lock, local
+from time import monotonic, perf_counter, sleep, time
 
+import numpy as np
 import pandas as pd
-from pybliometrics.scopus import ContentAffiliationRetrieval, ScopusSearch
-from pybliometrics.scopus.exception import ScopusException
+from pybliometrics.scopus.exception import Scopus404Error, Scopus429Error,\
+    Scopus500Error, Scopus502Error, Scopus504Error
+
+from scopus_backend import ContentAffiliationRetrieval, ScopusSearch
+from source_data import SOURCE_COLUMNS, print_progress, source_stamp
+
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+    from pyarrow import parquet as pq
+except ImportError:
+    pa = None
 
 SOURCE_FOLDER = "./002_journal_samples/"
 CORRECTION_FILE = "./095_affiliation_correction/countries.csv"
@@ -19,13 +43,31 @@ AFFILIATION_BLACKLIST = "./097_affiliation_blacklist/blacklist.csv"
 COUNTRY_WHITELIST = "./098_country_whitelist/oecd_others.csv"
 COUNTRYCOMB_FOLDER = "./100_country_combinations/"
 ARTICLES_FOLDER = "./100_source_articles/"
+DATASET_FOLDER = "./100_source_dataset/"
 META_FOLDER = "./100_meta_counts/"
+MANIFEST_FILE = "./100_meta_counts/manifest.sqlite"
+AFFILIATION_STORE = "./099_affiliation_store/affiliations.sqlite"
+STATS_FOLDER = "./100_crawl_stats/"
 OUTPUT_FOLDER = "./990_output/"
 
 START = 1996  # The first year of our data
 END = 2019  # The last year of our data
 PUB_TYPES = {'ar', 're', 'no', 'cp', 'ip', 'sh'}
 CHUNK_SIZE = 1300000  # Limit files to this number of lines
+WRITE_DATASET = True  # Mirror source files in Parquet dataset (needs pyarrow)
+FETCH_THREADS = 1  # Number of concurrent Scopus queries (1 = sequential)
+QUERY_RATE = None  # Maximum number of Scopus queries per second (None = no limit)
+BATCH_SIZE = 1  # Number of sources combined into one Scopus query
+SOURCE_CENTRIC = False  # Query each source once per year for all its fields
+MULTI_YEAR = False  # Query each source once for all years
+FLUSH_EVERY = 25  # Write meta counts after this many finished field-years
+PREFETCH_THREADS = 8  # Concurrent affiliation retrievals (0 = no prefetch)
+PREFETCH_WINDOW = 1000  # Number of sources whose affiliations are prefetched
+RETRIEVAL_RATE = None  # Maximum number of affiliation retrievals per second
+MAX_ATTEMPTS = 6  # Attempts per request on throttling or server errors
+BACKOFF = 2  # Seconds to wait after the first throttled request (doubling)
+REPAIR_SIZE = 25  # Number of EIDs per query when repairing results
+META_STUBS = ("nonorg_papers", "publications", "articles", "useful", "used")
 
 # Countries we look at
 _country_whitelist = set(pd.read_csv(COUNTRY_WHITELIST)['country'])
@@ -34,6 +76,8 @@ df = pd.read_csv(AFFILIATION_BLACKLIST, index_col=0)
 df.index = df.index.astype(str)
 df['children'] = df['children'].str.split(', ').apply(set)
 _affiliation_blacklist = df['children'].to_dict()
+_blacklist_parents = (df['children'].explode().reset_index()
+                        .groupby('children')['scopus_id'].agg(set).to_dict())
 # Definitions
 config = ConfigParser()
 config.optionxform = str
@@ -41,11 +85,404 @@ config.read("./definitions.cfg")
 _aff_map = dict(config["org types"])
 _country_map = dict(config["country names"])
 # Auxiliary containers
-_aff_countries = pd.read_csv(CORRECTION_FILE, dtype=object)
-_aff_countries = _aff_countries.set_index("scopus_id")["country"].to_dict()
-_aff_types = {}
 _aff_missing_countries = set()
 
+Affiliation = namedtuple("Affiliation",
+                         "aff_id country org_type name fetched corrected")
+
+
+class RateLimiter:
+    """Thread-safe limiter spacing out calls to at most `rate` per second."""
+
+    def __init__(self, rate):
+        self.interval = 1/rate if rate else 0
+        self._lock = Lock()
+        self._next = monotonic()
+
+    def wait(self):
+        """Block until the next call is allowed."""
+        if not self.interval:
+            return
+        with self._lock:
+            now = monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            sleep(delay)
+
+
+class CrawlStats:
+    """Thread-safe collection of stage timings and counters of a crawl."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """Discard collected information and restart the clock."""
+        with self._lock:
+            self.timings = defaultdict(list)
+            self.counters = defaultdict(int)
+            self.start = perf_counter()
+
+    def add_time(self, name, seconds):
+        """Record duration of one occurrence of a stage."""
+        with self._lock:
+            self.timings[name].append(seconds)
+
+    def count(self, name, n=1):
+        """Increase counter by `n`."""
+        with self._lock:
+            self.counters[name] += n
+
+    @contextmanager
+    def timer(self, name):
+        """Context manager recording the duration of a stage."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, perf_counter() - start)
+
+    def summary(self):
+        """Return dictionary with latency percentiles and counters."""
+        with self._lock:
+            out = {"elapsed": perf_counter() - self.start,
+                   "counters": dict(self.counters), "timings": {}}
+            for name, values in self.timings.items():
+                p50, p90, p99 = np.percentile(values, [50, 90, 99])
+                out["timings"][name] = {
+                    "n": len(values), "total": sum(values), "p50": p50,
+                    "p90": p90, "p99": p99, "max": max(values)}
+        return out
+
+    def write(self, fname, **extra):
+        """Write summary and further information as JSON file."""
+        out = self.summary()
+        out.update(extra)
+        with open(fname, "w") as ouf:
+            json.dump(out, ouf, indent=2)
+
+
+_query_limiter = RateLimiter(QUERY_RATE)
+_retrieval_limiter = RateLimiter(RETRIEVAL_RATE)
+
+
+class AffiliationStore:
+    """Persistent store of affiliation metadata shared by all processes
+    and threads, seeded with corrected countries.
+
+    Records hold the country, org type and name as returned by Scopus
+    together with the time of retrieval.  Corrected countries take
+    precedence over retrieved ones.
+    """
+
+    def __init__(self, fname, corrections=None):
+        self.fname = fname
+        self.corrections = corrections
+        self.reset()
+
+    def reset(self):
+        """Drop connections and cached records, e.g. in a new process."""
+        self._local = local()
+        self._cache = {}
+
+    @property
+    def con(self):
+        """Connection of the current thread, created on first use."""
+        try:
+            return self._local.con
+        except AttributeError:
+            con = sqlite3.connect(self.fname, timeout=60)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("CREATE TABLE IF NOT EXISTS affiliations (aff_id "
+                        "TEXT PRIMARY KEY, country TEXT, org_type TEXT, "
+                        "name TEXT, fetched REAL, corrected INTEGER)")
+            if self.corrections:
+                self._seed(con)
+            self._local.con = con
+            return con
+
+    def _seed(self, con):
+        """Insert or update corrected countries."""
+        df = pd.read_csv(self.corrections, dtype=object)
+        seeds = df[["scopus_id", "country"]].itertuples(index=False)
+        con.executemany("INSERT INTO affiliations (aff_id, country, "
+                        "corrected) VALUES (?, ?, 1) ON CONFLICT(aff_id) DO "
+                        "UPDATE SET country = excluded.country, corrected = 1",
+                        seeds)
+        con.commit()
+
+    def get(self, aff_id):
+        """Return record of an affiliation or None if it is unknown."""
+        return self.get_many([aff_id]).get(aff_id)
+
+    def get_many(self, aff_ids):
+        """Return dictionary of known records for several affiliations."""
+        out = {a: self._cache[a] for a in aff_ids if a in self._cache}
+        missing = [a for a in aff_ids if a not in out]
+        for start in range(0, len(missing), 500):
+            batch = missing[start:start+500]
+            marks = ", ".join("?" * len(batch))
+            q = f"SELECT * FROM affiliations WHERE aff_id IN ({marks})"
+            for rec in self.con.execute(q, batch):
+                rec = Affiliation(*rec)
+                self._cache[rec.aff_id] = out[rec.aff_id] = rec
+        return out
+
+    def put(self, aff_id, country, org_type, name):
+        """Store information retrieved from Scopus and return the record."""
+        return self.put_many([(aff_id, country, org_type, name)])[aff_id]
+
+    def put_many(self, values):
+        """Store information retrieved from Scopus for several affiliations
+        and return dictionary of the resulting records.
+        """
+        now = time()
+        rows = [(*v, now) for v in values]
+        self.con.executemany("INSERT INTO affiliations VALUES "
+                             "(?, ?, ?, ?, ?, 0) ON CONFLICT(aff_id) DO "
+                             "UPDATE SET org_type = excluded.org_type, "
+                             "name = excluded.name, fetched = excluded.fetched, "
+                             "country = CASE WHEN corrected THEN country "
+                             "ELSE excluded.country END", rows)
+        self.con.commit()
+        aff_ids = [v[0] for v in values]
+        for aff_id in aff_ids:
+            self._cache.pop(aff_id, None)
+        return self.get_many(aff_ids)
+
+
+_affiliations = AffiliationStore(AFFILIATION_STORE, corrections=CORRECTION_FILE)
+_stats = CrawlStats()
+
+
+class ArticleWriter:
+    """Stream author-level rows of a field-year into rolling chunk files
+    of at most `chunk_size` rows each.
+    """
+
+    columns = SOURCE_COLUMNS
+
+    def __init__(self, asjc, year, chunk_size=CHUNK_SIZE):
+        self.asjc = asjc
+        self.year = year
+        self.chunk_size = chunk_size
+        self.chunk = -1
+        self.n_rows = 0
+        self.fname = None
+        self._file = None
+        self._writer = None
+
+    def _roll(self):
+        """Close current chunk file and open the next one."""
+        self.close()
+        self.chunk += 1
+        self.fname = f"{ARTICLES_FOLDER}articles_{self.asjc}-{self.year}_{self.chunk}.csv"
+        self._file = open(self.fname, "w", newline="", encoding="utf8")
+        self._writer = csv.writer(self._file, lineterminator=os.linesep)
+        self._writer.writerow(self.columns)
+
+    def write(self, rows):
+        """Append rows, starting new chunk files as needed."""
+        for row in rows:
+            if self.n_rows % self.chunk_size == 0:
+                self._roll()
+            self._writer.writerow(row)
+            self.n_rows += 1
+
+    def close(self):
+        """Close current chunk file and mirror it in the dataset."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            if WRITE_DATASET and pa is not None:
+                write_partition(self.fname, self.asjc, self.year, self.chunk)
+
+
+def write_partition(fname, asjc, year, chunk):
+    """Write source file `fname` as part `chunk` of the partition of the
+    field-year in DATASET_FOLDER, with dictionary-encoded countries and
+    types and the stamp of `fname` in its metadata.  Parts of earlier
+    crawls are removed with the first part.
+    """
+    categorical = pa.dictionary(pa.int32(), pa.string())
+    types = {"eid": pa.string(), "source_id": pa.uint64(),
+             "author": pa.uint64(), "author_count": pa.uint16(),
+             "affiliations": pa.string(), "countries": categorical,
+             "types": categorical}
+    options = pa_csv.ConvertOptions(column_types=types)
+    table = pa_csv.read_csv(fname, convert_options=options)
+    stamp = json.dumps(source_stamp(fname)).encode()
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                           b"source": stamp})
+    folder = f"{DATASET_FOLDER}field={asjc}/year={year}/"
+    if int(chunk) == 0:
+        shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder, exist_ok=True)
+    pq.write_table(table, f"{folder}part-{chunk}.parquet")
+
+
+def convert_source_files():
+    """Mirror all existing source files in the Parquet dataset."""
+    files = sorted(glob(ARTICLES_FOLDER + "articles_*.csv"))
+    print(f">>> Converting {len(files):,} source files...")
+    print_progress(0, len(files))
+    for i, fname in enumerate(files):
+        key, chunk = splitext(basename(fname))[0].split("_")[1:]
+        asjc, year = key.split("-")
+        write_partition(fname, asjc, year, chunk)
+        print_progress(i+1, len(files))
+
+
+class MetaCounts:
+    """Yearly count panels by field kept in memory and written to
+    META_FOLDER atomically every `flush_every` field-years.
+    """
+
+    def __init__(self, flush_every=FLUSH_EVERY, read=True):
+        self.flush_every = flush_every
+        self.panels = {stub: self._read(stub) if read else pd.DataFrame()
+                       for stub in META_STUBS}
+        self._pending = 0
+
+    @staticmethod
+    def _fname(stub):
+        """Name of the file of a panel."""
+        return f"{META_FOLDER}num_{stub}.csv"
+
+    def _read(self, stub):
+        """Read existing panel."""
+        try:
+            return pd.read_csv(self._fname(stub), index_col=0)
+        except FileNotFoundError:
+            return pd.DataFrame()
+
+    def set(self, asjc, year, counts):
+        """Set counts of a field-year and flush if checkpoint is reached."""
+        for stub, value in counts.items():
+            self.panels[stub].loc[year, asjc] = value
+        self._pending += 1
+        if self.flush_every and self._pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Write all panels, replacing existing files atomically."""
+        for stub, dat in self.panels.items():
+            dat = dat[sorted(dat.columns)].sort_index()
+            complete = dat.columns[dat.notnull().all()]
+            dat[complete] = dat[complete].astype("int64")
+            fname = self._fname(stub)
+            dat.to_csv(fname + ".tmp", index_label="year")
+            os.replace(fname + ".tmp", fname)
+        self._pending = 0
+
+
+class CrawlManifest:
+    """Persistent record of finished work units (asjc, year, source_id)
+    together with their partial counts and parsed rows.
+
+    Rows are kept only until the field-year they belong to is written out.
+    """
+
+    def __init__(self, fname):
+        self.con = sqlite3.connect(fname, timeout=60)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        counts = ", ".join(f"{stub} INTEGER" for stub in META_STUBS)
+        self.con.execute("CREATE TABLE IF NOT EXISTS units (asjc TEXT, "
+                         f"year INTEGER, source_id INTEGER, {counts}, "
+                         "rows BLOB, PRIMARY KEY (asjc, year, source_id))")
+        self.con.execute("CREATE TABLE IF NOT EXISTS written (asjc TEXT, "
+                         "year INTEGER, sources TEXT, "
+                         "PRIMARY KEY (asjc, year))")
+        # Field-years written before sources were recorded count as outdated
+        columns = [r[1] for r in self.con.execute("PRAGMA table_info(written)")]
+        if "sources" not in columns:
+            self.con.execute("ALTER TABLE written ADD COLUMN sources TEXT")
+        self.con.commit()
+
+    @staticmethod
+    def digest(source_ids):
+        """Hash of the source IDs of a field."""
+        ids = ",".join(sorted(str(s) for s in source_ids))
+        return sha1(ids.encode("utf8")).hexdigest()
+
+    def add(self, asjc, year, source_id, counts, rows):
+        """Record a finished work unit."""
+        blob = zlib.compress(json.dumps(rows).encode("utf8"))
+        values = [counts[stub] for stub in META_STUBS]
+        marks = ", ".join("?" * (len(META_STUBS) + 4))
+        self.con.execute(f"INSERT OR REPLACE INTO units VALUES ({marks})",
+                         (asjc, year, source_id, *values, blob))
+        self.con.commit()
+
+    def clear(self):
+        """Forget all finished work to crawl anew."""
+        self.con.execute("DELETE FROM units")
+        self.con.execute("DELETE FROM written")
+        self.con.commit()
+
+    def counts(self):
+        """Return DataFrame with counts of written field-years summed by
+        field and year.
+        """
+        sums = ", ".join(f"SUM({stub}) AS {stub}" for stub in META_STUBS)
+        q = (f"SELECT asjc, year, {sums} FROM units JOIN written "
+             "USING (asjc, year) GROUP BY asjc, year")
+        return pd.read_sql_query(q, self.con)
+
+    def is_written(self, asjc, year, source_ids):
+        """Whether the source files of a field-year are complete for the
+        field's sources `source_ids`.
+        """
+        q = "SELECT sources FROM written WHERE asjc = ? AND year = ?"
+        row = self.con.execute(q, (asjc, year)).fetchone()
+        return row is not None and row[0] == self.digest(source_ids)
+
+    def mark_written(self, asjc, year, source_ids):
+        """Flag field-year as written for the field's sources `source_ids`
+        and drop its no longer needed rows.
+        """
+        self.con.execute("INSERT OR REPLACE INTO written VALUES (?, ?, ?)",
+                         (asjc, year, self.digest(source_ids)))
+        self.con.execute("UPDATE units SET rows = NULL WHERE asjc = ? "
+                         "AND year = ?", (asjc, year))
+        self.con.commit()
+
+    def reset(self, asjc, year, source_ids):
+        """Unflag field-year as written and drop units of sources other
+        than `source_ids` as well as units whose rows were dropped.
+        """
+        self.con.execute("DELETE FROM written WHERE asjc = ? AND year = ?",
+                         (asjc, year))
+        q = "SELECT source_id FROM units WHERE asjc = ? AND year = ?"
+        keep = set(source_ids)
+        drop = [(asjc, year, s) for s, in self.con.execute(q, (asjc, year))
+                if s not in keep]
+        self.con.executemany("DELETE FROM units WHERE asjc = ? AND year = ? "
+                             "AND source_id = ?", drop)
+        self.con.execute("DELETE FROM units WHERE asjc = ? AND year = ? "
+                         "AND rows IS NULL", (asjc, year))
+        self.con.commit()
+
+    def rows(self, asjc, year, source_id):
+        """Return parsed rows of a finished work unit."""
+        q = "SELECT rows FROM units WHERE asjc = ? AND year = ? AND source_id = ?"
+        blob = self.con.execute(q, (asjc, year, source_id)).fetchone()[0]
+        return json.loads(zlib.decompress(blob).decode("utf8"))
+
+    def units(self, asjc, year):
+        """Return dictionary of finished units of a field-year mapping
+        source ID to counts.
+        """
+        stubs = ", ".join(META_STUBS)
+        q = (f"SELECT source_id, {stubs} FROM units "
+             "WHERE asjc = ? AND year = ? AND rows IS NOT NULL")
+        out = {}
+        for source_id, *values in self.con.execute(q, (asjc, year)):
+            out[source_id] = dict(zip(META_STUBS, values))
+        return out
+
 
 def count_pages(s):
     """Attempt to compute the number of pages of an article."""
@@ -69,156 +506,494 @@ def get_affiliations(pub):
         org = [a for a in auth_affs if a]
         nonorg.extend([a for a in auth_affs if a.startswith('1')])
         # Filter university systems if their children are present too
-        intersection = set(org).intersection(_affiliation_blacklist.keys())
-        for parent in intersection:
-            children = _affiliation_blacklist[parent]
-            if children.intersection(auth_affs):
-                org.remove(parent)
+        parents = set()
+        for aff in auth_affs:
+            parents.update(_blacklist_parents.get(aff, ()))
+        for parent in parents.intersection(org):
+            org.remove(parent)
         affs.append(org)
     return affs, len(nonorg)
 
 
+def get_affiliation(aff_id, refresh=350, full=False, kind="affiliation"):
+    """Return stored record of an affiliation, retrieving it from Scopus
+    if it is unknown or older than `refresh` days.
+
+    Records with only a corrected country are accepted unless `full`.
+    Lookups are counted as hit or miss for `kind`.
+    """
+    rec = _affiliations.get(aff_id)
+    if is_current(rec, refresh, full):
+        _stats.count(f"{kind}_hit")
+        return rec
+    _stats.count(f"{kind}_miss")
+    return _affiliations.put(*retrieve_affiliation(aff_id, refresh))
+
+
 def get_country(aff_id, refresh=350):
     """Get country of an affiliation."""
-    try:
-        country = _aff_countries[aff_id]
-    except KeyError:
-        try:
-            aff = ContentAffiliationRetrieval(aff_id, refresh=refresh)
-            country = aff.country or "Unknown"
-        except ScopusException:
-            country = "Unknown"
-        if aff_id.startswith("6") and country == "Unknown":
-            _aff_missing_countries.add(aff_id)
-        country = _country_map.get(country, country)
-        _aff_countries[aff_id] = country
-    return country
+    rec = get_affiliation(aff_id, refresh=refresh, kind="country")
+    country = rec.country or "Unknown"
+    if aff_id.startswith("6") and country == "Unknown":
+        _aff_missing_countries.add(aff_id)
+    return _country_map.get(country, country)
+
+
+def get_name(aff_id, refresh=350):
+    """Get name of an affiliation."""
+    return get_affiliation(aff_id, refresh=refresh, full=True, kind="name").name
 
 
 def get_type(aff_ids, refresh=350):
     """Return types of affiliations recorded by Scopus."""
     out = []
     for aff_id in aff_ids:
-        # Use parsed information or load new information
-        try:
-            aff_type = _aff_types[aff_id]
-        except KeyError:
-            if aff_id.startswith("1"):
+        if aff_id.startswith("1"):
+            aff_type = "?"
+        else:
+            rec = get_affiliation(aff_id, refresh, full=True, kind="type")
+            org_type = rec.org_type
+            try:
+                aff_type = org_type.split("|")[0]
+                aff_type = _aff_map.get(aff_type, aff_type)
+            except AttributeError:
                 aff_type = "?"
-            else:
-                try:
-                    aff = ContentAffiliationRetrieval(aff_id, refresh=refresh)
-                    aff_type = aff.org_type.split("|")[0]
-                    aff_type = _aff_map.get(aff_type, aff_type)
-                except (AttributeError, ScopusException):
-                    aff_type = "?"
-            _aff_types[aff_id] = aff_type
         out.append(aff_type)
     return tuple(sorted(out, reverse=True))
 
 
-def panel_write_or_add(fname, value, field, year):
-    """Write DataFrame with information on yearly counts to a file that might
-    already exist.
+def parse_publications(pubs, source_id):
+    """Parse publications of one source into author-level rows and count
+    publications at different stages of filtering.
+    """
+    counts = dict.fromkeys(META_STUBS, 0)
+    rows = []
+    # Filter publications
+    counts["publications"] = len(pubs)
+    pubs = [p for p in pubs if p.subtype and p.subtype in PUB_TYPES]
+    counts["articles"] = len(pubs)
+    pubs = [p for p in pubs if p.author_afids and p.author_ids]
+    counts["useful"] = len(pubs)
+    # Parse information document-wise
+    with _stats.timer("get_affiliations"):
+        parsed = [get_affiliations(pub) for pub in pubs]
+    for pub, (affs, nonorg) in zip(pubs, parsed):
+        valid = False
+        auths = pub.author_ids.split(";")
+        if nonorg:  # At least one author-affiliation obs not useful
+            counts["nonorg_papers"] += 1
+        # Parse information author-wise
+        for auth, auth_affs in zip(auths, affs):
+            if len(auth) == 1 or not auth_affs:
+                continue
+            # Country-information
+            countries = [get_country(a) for a in auth_affs]
+            first_country = countries[0]
+            if first_country not in _country_whitelist or not countries:
+                continue
+            # Finalize
+            new = [pub.eid, source_id, auth, pub.author_count,
+                   ";".join(auth_affs), "-".join(countries),
+                   "-".join(get_type(auth_affs))]
+            rows.append(new)
+            valid = True
+        if valid:
+            counts["used"] += 1
+    return counts, rows
+
+
+def is_current(rec, refresh, full=False):
+    """Whether an affiliation record can be used without retrieving it."""
+    if rec is None:
+        return False
+    if rec.fetched is not None and time() - rec.fetched < refresh*86400:
+        return True
+    return bool(rec.corrected and not full)
+
+
+def split_by_source(pubs):
+    """Group publications by their source ID."""
+    groups = {}
+    for pub in pubs:
+        groups.setdefault(pub.source_id, []).append(pub)
+    return groups
+
+
+def split_by_year(pubs, years):
+    """Group publications by the year of their cover date, with records
+    lacking a cover date under None.
+    """
+    if len(years) == 1:
+        return {years[0]: pubs}
+    groups = {year: [] for year in years}
+    for pub in pubs:
+        if not pub.coverDate:  # Unrepaired records cannot be attributed
+            groups.setdefault(None, []).append(pub)
+            continue
+        year = int(pub.coverDate[:4])
+        if year in groups:
+            groups[year].append(pub)
+    return groups
+
+
+def read_samples():
+    """Read sampled source IDs by field."""
+    samples = {}
+    for f in glob(SOURCE_FOLDER + "[0-9][0-9].csv"):
+        asjc = splitext(basename(f))[0]
+        samples[asjc] = pd.read_csv(f)['Sourceid'].tolist()
+    return samples
+
+
+def rebuild_meta_counts(manifest):
+    """Write yearly count panels of written field-years using information
+    from the manifest only and return them.
+    """
+    meta = MetaCounts(flush_every=None, read=False)
+    for asjc, year, *values in manifest.counts().itertuples(index=False):
+        meta.set(asjc, year, dict(zip(META_STUBS, values)))
+    meta.flush()
+    meta.flush_every = FLUSH_EVERY
+    return meta
+
+
+def prefetch_affiliations(pubs, refresh=350, threads=PREFETCH_THREADS):
+    """Retrieve unknown or outdated affiliations of publications in
+    parallel and store them.
+
+    Stored affiliations are counted as prefetch hits, the others as
+    prefetch misses, as later lookups of the publications all hit.
+    """
+    aff_ids = set()
+    for pub in pubs:
+        if not (pub.subtype in PUB_TYPES and pub.author_afids and pub.author_ids):
+            continue
+        affs, _ = get_affiliations(pub)
+        for auth, auth_affs in zip(pub.author_ids.split(";"), affs):
+            if len(auth) > 1:
+                aff_ids.update(auth_affs)
+    aff_ids = sorted(aff_ids)
+    known = _affiliations.get_many(aff_ids)
+    missing = [a for a in aff_ids if not
+               is_current(known.get(a), refresh, full=not a.startswith("1"))]
+    _stats.count("prefetch_hit", len(aff_ids) - len(missing))
+    _stats.count("prefetch_miss", len(missing))
+    if not missing:
+        return
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        values = executor.map(lambda a: retrieve_affiliation(a, refresh), missing)
+        _affiliations.put_many(list(values))
+
+
+def prefetch_sources(results, window=PREFETCH_WINDOW):
+    """Pass through publications by source and year while prefetching
+    affiliations of `window` sources at a time.
+    """
+    while True:
+        batch = list(islice(results, window))
+        if not batch:
+            return
+        pubs = [p for by_year in batch for year_pubs in by_year.values()
+                for p in year_pubs]
+        with _stats.timer("prefetch"):
+            prefetch_affiliations(pubs)
+        yield from batch
+
+
+def fetch_queries(queries, refresh=False, threads=FETCH_THREADS):
+    """Yield results of `queries` in their original order while running
+    up to `threads` queries concurrently.
+    """
+    if threads < 2:
+        for q in queries:
+            yield robust_query(q, refresh=refresh)
+        return
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for q in queries:
+            pending.append(executor.submit(robust_query, q, refresh))
+            # Bound the number of results waiting to be consumed
+            if len(pending) > 2*threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def fetch_sources(source_ids, years, refresh=False, batch_size=BATCH_SIZE):
+    """Yield publications of each source in `source_ids` as dictionary
+    keyed by year, combining up to `batch_size` sources in one query.
+
+    Several years are fetched with one query per batch and partitioned
+    locally by the publications' cover date.  Sources with records lacking
+    a cover date are queried year by year instead.
+    """
+    if len(years) == 1:
+        period = f"PUBYEAR IS {years[0]}"
+    else:
+        period = f"PUBYEAR > {min(years)-1} AND PUBYEAR < {max(years)+1}"
+    batches = [source_ids[i:i+batch_size]
+               for i in range(0, len(source_ids), batch_size)]
+    queries = []
+    for batch in batches:
+        sources = " OR ".join(f"SOURCE-ID({source_id})" for source_id in batch)
+        if len(batch) > 1:
+            sources = f"({sources})"
+        queries.append(f"{sources} AND {period}")
+    for batch, pubs in zip(batches, fetch_queries(queries, refresh=refresh)):
+        if len(batch) == 1:
+            groups = {str(batch[0]): pubs}
+        else:
+            groups = split_by_source(pubs)
+        for source_id in batch:
+            by_year = split_by_year(groups.get(str(source_id), []), years)
+            if None in by_year:
+                _stats.count("undated", len(by_year[None]))
+                by_year = {year: robust_query(f"SOURCE-ID({source_id}) AND "
+                                              f"PUBYEAR IS {year}", refresh)
+                           for year in years}
+            yield by_year
+
+
+def retrieve_affiliation(aff_id, refresh=350):
+    """Retrieve country, org type and name of an affiliation from Scopus.
+
+    Only affiliations Scopus does not know are returned without
+    information; other errors are raised such that nothing is stored.
     """
     try:
-        dat = pd.read_csv(fname, index_col=0)
-    except FileNotFoundError:
-        dat = pd.DataFrame()
-    dat.loc[year, field] = value
-    dat = dat[sorted(dat.columns)].sort_index()
-    dat.to_csv(fname, index_label="year")
+        aff = request(ContentAffiliationRetrieval, aff_id, refresh=refresh,
+                      limiter=_retrieval_limiter, stage="retrieval")
+        return aff_id, aff.country, aff.org_type, aff.affiliation_name
+    except Scopus404Error:
+        return aff_id, None, None, None
+
+
+def request(cls, *args, limiter=None, stage="query", **kwds):
+    """Instantiate Scopus class, retrying throttled requests and server
+    errors with exponential backoff.
+    """
+    limiter = limiter or _query_limiter
+    for attempt in range(MAX_ATTEMPTS):
+        limiter.wait()
+        try:
+            with _stats.timer(stage):
+                return cls(*args, **kwds)
+        except (Scopus429Error, Scopus500Error, Scopus502Error,
+                Scopus504Error) as err:
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            if isinstance(err, Scopus429Error):
+                _stats.count(f"{stage}_throttled")
+                sleep(BACKOFF * 2**attempt)
+            else:
+                _stats.count(f"{stage}_server_error")
+                sleep(BACKOFF)
 
 
-def print_progress(iteration, total, length=50):
-    """Print terminal progress bar."""
-    share = iteration / float(total)
-    filled_len = int(length * iteration // total)
-    bar = "█" * filled_len + "-" * (length - filled_len)
-    print(f"\rProgress: |{bar}| {share:.2%} complete", end="\r")
-    if iteration == total:
-        print()
+def incomplete(res, fields):
+    """Return positions of records lacking information in `fields`."""
+    return [i for i, r in enumerate(res)
+            if any(getattr(r, f) is None for f in fields)]
+
+
+def repair_results(res, fields, refresh=False):
+    """Replace records lacking information in `fields` with records
+    re-fetched by EID, first from cache and then anew.
+
+    Return None if records without EID prevent a repair.
+    """
+    for attempt_refresh in (refresh, True):
+        bad = incomplete(res, fields)
+        if not bad:
+            break
+        eids = [res[i].eid for i in bad]
+        if None in eids:
+            return None
+        fixed = {}
+        for start in range(0, len(eids), REPAIR_SIZE):
+            q = " OR ".join(f"EID({e})" for e in eids[start:start+REPAIR_SIZE])
+            s = request(ScopusSearch, q, refresh=attempt_refresh,
+                        integrity_fields=fields, integrity_action="warn")
+            fixed.update({r.eid: r for r in s.results or []})
+        for i in bad:
+            res[i] = fixed.get(res[i].eid, res[i])
+    return res
 
 
 def robust_query(q, refresh=False, fields=("eid", "coverDate")):
-    """Wrapper function for individual ScopusSearch query."""
+    """Wrapper function for individual ScopusSearch query.
+
+    Records failing the integrity check are re-fetched individually and
+    merged into the result; the whole result is only downloaded anew if
+    records cannot be addressed or the cached or downloaded JSON is broken.
+    """
     try:
-        s = ScopusSearch(q, refresh=refresh, integrity_fields=fields)
-        res = s.results
-    except (AttributeError, KeyError):
-        res = ScopusSearch(q, refresh=True).results
-    return res or []
+        s = request(ScopusSearch, q, refresh=refresh, integrity_fields=fields,
+                    integrity_action="warn")
+    except KeyError:
+        _stats.count("broken_refetch")
+        s = request(ScopusSearch, q, refresh=True, integrity_fields=fields,
+                    integrity_action="warn")
+    res = s.results or []
+    if incomplete(res, fields):
+        _stats.count("integrity_repair")
+        repaired = repair_results(res, fields, refresh=refresh)
+        if repaired is None:
+            _stats.count("integrity_refetch")
+            repaired = request(ScopusSearch, q, refresh=True).results or []
+        res = repaired
+    return res
 
 
-def main():
-    order = ["eid", "source_id", "author", "author_count", "affiliations",
-             "countries", "types"]
-    # Parse each field individually
-    for f in glob(SOURCE_FOLDER + "[0-9][0-9].csv"):
-        asjc = splitext(basename(f))[0]
-        source_ids = pd.read_csv(f)['Sourceid'].tolist()
-        n_sources = len(source_ids)
-        print(f">>> Working on field {asjc} using up to {n_sources:,} sources...")
-        for year in range(START, END+1):
-            # Containers
-            n_pubs = 0
-            n_articles = 0
-            n_useful = 0
-            n_used = 0
-            n_nonorgp = 0
-            docs = []
-            print(f"... processing publications for {year}...")
-            print_progress(0, n_sources)
-            for i, source_id in enumerate(source_ids):
-                # Download publications and filter
-                q = f"SOURCE-ID({source_id}) AND PUBYEAR IS {year}"
-                pubs = robust_query(q, refresh=600)
-                n_pubs += len(pubs)
-                pubs = [p for p in pubs if p.subtype and p.subtype in PUB_TYPES]
-                n_articles += len(pubs)
-                pubs = [p for p in pubs if p.author_afids and p.author_ids]
-                n_useful += len(pubs)
-                # Parse information document-wise
-                print_progress(i+1, n_sources)
-                for pub in pubs:
-                    valid = False
-                    auths = pub.author_ids.split(";")
-                    affs, nonorg = get_affiliations(pub)
-                    if nonorg:  # At least one author-affiliation obs not useful
-                        n_nonorgp += 1
-                    # Parse information author-wise
-                    for auth, auth_affs in zip(auths, affs):
-                        if len(auth) == 1 or not auth_affs:
-                            continue
-                        # Country-information
-                        countries = [get_country(a) for a in auth_affs]
-                        first_country = countries[0]
-                        if first_country not in _country_whitelist or not countries:
-                            continue
-                        # Finalize
-                        new = [pub.eid, source_id, auth, pub.author_count,
-                               ";".join(auth_affs), "-".join(countries),
-                               "-".join(get_type(auth_affs))]
-                        docs.append(new)
-                        valid = True
-                    if valid:
-                        n_used += 1
-
-            # Write documents in chunks
-            docs = pd.DataFrame(docs, columns=order)[order].set_index("eid")
-            n_chunks = ceil(docs.shape[0]/CHUNK_SIZE)
-            for chunk in range(n_chunks):
-                fname = f"{ARTICLES_FOLDER}articles_{asjc}-{year}_{chunk}.csv"
-                start = chunk*CHUNK_SIZE
-                end = (chunk+1)*CHUNK_SIZE
-                docs.iloc[start:end].to_csv(fname)
-            del docs
-            # Statistics
-            combs = [("nonorg_papers", n_nonorgp), ("publications", n_pubs),
-                     ("articles", n_articles), ("useful", n_useful), ("used", n_used)]
-            for stub, data in combs:
-                fname = f"{META_FOLDER}num_{stub}.csv"
-                panel_write_or_add(fname, data, asjc, year)
+def crawl(samples, years, manifest):
+    """Download and parse publications of `years` for all sources in
+    `samples`, write source files and return counts by field-year.
+
+    Each source is queried and parsed once and its rows are attached to
+    every field it belongs to, in the order in which sources first appear.
+    """
+    # Collect field-years to work on and their finished work units
+    done = {}
+    for year in years:
+        for asjc, source_ids in samples.items():
+            if not manifest.is_written(asjc, year, source_ids):
+                manifest.reset(asjc, year, source_ids)
+                done[(asjc, year)] = manifest.units(asjc, year)
+    if not done:
+        print(f"... skipping {years_label(years)} (already complete, see --fresh)")
+        return {}
+    years = [y for y in years if any(key[1] == y for key in done)]
+    _stats.reset()
+    finished = {}
+    for (asjc, year), units in done.items():
+        for source_id, counts in units.items():
+            finished[(year, source_id)] = (asjc, counts)
+    # Map sources to fields
+    members = {}
+    for asjc, source_ids in samples.items():
+        for source_id in source_ids:
+            members.setdefault(source_id, []).append(asjc)
+    # Containers
+    totals = {key: dict.fromkeys(META_STUBS, 0) for key in done}
+    writers = {key: ArticleWriter(*key) for key in done}
+    n_sources = len(members)
+    print(f"... processing publications for {years_label(years)}...")
+    print_progress(0, n_sources)
+    missing = [source_id for source_id in members
+               if any((year, source_id) not in finished for year in years)]
+    results = fetch_sources(missing, years, refresh=600)
+    if PREFETCH_THREADS:
+        results = prefetch_sources(results)
+    missing = set(missing)
+    for i, (source_id, fields) in enumerate(members.items()):
+        if source_id in missing:
+            with _stats.timer("fetch_wait"):
+                pubs = next(results)
+        for year in years:
+            targets = [(asjc, year) for asjc in fields if (asjc, year) in done]
+            if not targets:
+                continue
+            # Reuse finished work units or parse
+            try:
+                asjc, counts = finished[(year, source_id)]
+                with _stats.timer("io"):
+                    rows = manifest.rows(asjc, year, source_id)
+            except KeyError:
+                with _stats.timer("parse"):
+                    counts, rows = parse_publications(pubs[year], source_id)
+            with _stats.timer("io"):
+                for key in targets:
+                    if source_id not in done[key]:
+                        manifest.add(*key, source_id, counts, rows)
+                    for stub, value in counts.items():
+                        totals[key][stub] += value
+                    writers[key].write(rows)
+        print_progress(i+1, n_sources)
+
+    # Write out
+    n_rows = {}
+    for asjc, year in done:
+        writer = writers.pop((asjc, year))
+        writer.close()
+        n_rows[f"{asjc}-{year}"] = writer.n_rows
+        manifest.mark_written(asjc, year, samples[asjc])
+    label = list(samples)[0] if len(samples) == 1 else "all"
+    fname = f"{STATS_FOLDER}{label}-{years_label(years)}.json"
+    elapsed = perf_counter() - _stats.start
+    _stats.write(fname, rows=n_rows, rows_per_second=sum(n_rows.values())/elapsed)
+    return totals
+
+
+def crawl_task(samples, years):
+    """Crawl in a worker process and return counts by field-year as well
+    as affiliation profiles without country.
+    """
+    manifest = CrawlManifest(MANIFEST_FILE)
+    return crawl(samples, years, manifest), _aff_missing_countries
+
+
+def init_worker(n_workers):
+    """Prepare worker process to share rate limits with `n_workers`
+    processes and to open own connections to the affiliation store.
+    """
+    global _query_limiter, _retrieval_limiter
+    _query_limiter = RateLimiter(QUERY_RATE and QUERY_RATE/n_workers)
+    _retrieval_limiter = RateLimiter(RETRIEVAL_RATE and RETRIEVAL_RATE/n_workers)
+    _affiliations.reset()
+
+
+def years_label(years):
+    """Format list of consecutive years for printing."""
+    if len(years) == 1:
+        return str(years[0])
+    return f"{years[0]}-{years[-1]}"
+
+
+def main(workers=1, fresh=False):
+    manifest = CrawlManifest(MANIFEST_FILE)
+    if fresh:
+        manifest.clear()
+    if not manifest.counts().empty:
+        print(">>> Resuming crawl, rebuilding meta counts from manifest...")
+        meta = rebuild_meta_counts(manifest)
+    else:
+        meta = MetaCounts()
+    samples = read_samples()
+    years = list(range(START, END+1))
+    if MULTI_YEAR:
+        periods = [years]
+    else:
+        periods = [[year] for year in years]
+    if SOURCE_CENTRIC:
+        # Parse each period for all fields at once
+        n_sources = len({s for source_ids in samples.values() for s in source_ids})
+        print(f">>> Working on {len(samples)} fields using up to "
+              f"{n_sources:,} distinct sources...")
+        tasks = [(samples, period) for period in periods]
+    else:
+        # Parse each field individually
+        tasks = [({asjc: source_ids}, period)
+                 for asjc, source_ids in samples.items() for period in periods]
+
+    if workers > 1:
+        print(f">>> Crawling {len(tasks):,} tasks using {workers} processes...")
+        with ProcessPoolExecutor(workers, initializer=init_worker,
+                                 initargs=(workers,)) as executor:
+            futures = [executor.submit(crawl_task, *task) for task in tasks]
+            for future in as_completed(futures):
+                totals, missing = future.result()
+                for key, counts in totals.items():
+                    meta.set(*key, counts)
+                _aff_missing_countries.update(missing)
+    else:
+        for task_samples, period in tasks:
+            if not SOURCE_CENTRIC and period == periods[0]:
+                asjc, source_ids = list(task_samples.items())[0]
+                print(f">>> Working on field {asjc} using up to "
+                      f"{len(source_ids):,} sources...")
+            for key, counts in crawl(task_samples, period, manifest).items():
+                meta.set(*key, counts)
+    meta.flush()
 
     # Maintenance
     if _aff_missing_countries:
@@ -227,4 +1002,17 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes parsing fields in parallel")
+    parser.add_argument("--convert", action="store_true",
+                        help="Only mirror existing source files in the "
+                             "Parquet dataset")
+    parser.add_argument("--fresh", action="store_true",
+                        help="Discard the manifest of earlier runs and "
+                             "crawl all field-years anew")
+    args = parser.parse_args()
+    if args.convert:
+        convert_source_files()
+    else:
+        main(workers=args.workers, fresh=args.fresh)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# Author:   Michael E. Rose <michael.ernst.rose@gmail.com>
+"""Computes flags of all rows of the source files once and stores them
+alongside: whether the author reports multiple affiliations, whether these
+are in different countries, the first country and the combination of
+affiliation types.
+"""
+
+from os import makedirs
+from os.path import exists, getmtime
+
+import pandas as pd
+
+from source_data import FLAGS_FOLDER, flags_file, print_progress,\
+    read_source_file, source_files
+
+
+def clean_types(type_str):
+    """Reduce multiple combinations of the same type to a dual combination."""
+    names = {"univ": "Univ.", "resi": "Res. Inst.", "comp": "Company",
+             "hosp": "Hospital", "govt": "Gov.", "ngov": "Non-Gov.",
+             "?": "Unknown"}
+    if "-" not in type_str:
+        return names.get(type_str, type_str)
+    types = {names.get(t, t) for t in set(type_str.split("-"))}
+    if len(types) == 1:
+        t = types.pop()
+        if t == "Unknown":
+            return "Other"
+        return f"{t}-{t}"
+    else:
+        types = sorted(types, reverse=True)
+        if types[0] == "Unknown":
+            types.pop(0)
+            types.append("Unknown")
+        return "-".join(types)
+
+
+def compute_flags(df):
+    """Compute flags from countries and types of source file rows."""
+    flags = pd.DataFrame(index=df.index)
+    flags["multiaff"] = (df["countries"].str.count("-") > 0).astype("uint8")
+    flags["country"] = df["countries"].str.split("-", n=1).str[0]
+    parts = df["countries"].str.split("-").explode()
+    foreign = parts.ne(flags["country"].reindex(parts.index))
+    flags["foreignaff"] = foreign.groupby(level=0).any().astype("uint8")
+    types = df["types"].dropna().unique()
+    cleaned = dict(zip(types, map(clean_types, types)))
+    flags["combination"] = df["types"].map(cleaned)
+    return flags[["multiaff", "foreignaff", "country", "combination"]]
+
+
+def main():
+    makedirs(FLAGS_FOLDER, exist_ok=True)
+    files = [f for f, _, _ in source_files()]
+    print(f">>> Enriching {len(files):,} source files...")
+    print_progress(0, len(files))
+    for i, fname in enumerate(files):
+        target = flags_file(fname)
+        if not exists(target) or getmtime(target) < getmtime(fname):
+            df = read_source_file(fname, ["countries", "types"])
+            flags = compute_flags(df.reset_index(drop=True))
+            if target.endswith(".parquet"):
+                for c in ("country", "combination"):
+                    flags[c] = flags[c].astype("category")
+                flags.to_parquet(target, index=False)
+            else:
+                flags.to_csv(target, index=False, encoding="utf8")
+        print_progress(i+1, len(files))
+
+
+if __name__ == '__main__':
+    main()
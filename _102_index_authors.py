@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# Author:   Michael E. Rose <michael.ernst.rose@gmail.com>
+"""Indexes the unique authors of the source files by field, year and
+country of first affiliation, such that unique counts over any selection
+need not read the source files.
+"""
+
+from os import makedirs
+
+import numpy as np
+import pandas as pd
+
+from source_data import INDEX_FOLDER, index_file, is_outdated,\
+    print_progress, read_source_file, source_files, source_versions
+
+
+def index_authors(fnames, target):
+    """Write sorted unique author IDs by country of files `fnames` to
+    `target`, delta-encoded and compressed, with the versions of the
+    files read.
+    """
+    versions = source_versions(fnames)
+    df = pd.concat([read_source_file(f, ["author", "country"],
+                                     dtype={"author": "uint64"})
+                    for f in fnames])
+    df = df.drop_duplicates()
+    country = df["country"].fillna("").to_numpy(dtype=str)
+    ids = df["author"].to_numpy()
+    order = np.lexsort((ids, country))
+    country, ids = country[order], ids[order]
+    countries, starts, sizes = np.unique(country, return_index=True,
+                                         return_counts=True)
+    deltas = np.diff(ids, prepend=np.uint64(0))
+    deltas[starts] = ids[starts]
+    np.savez_compressed(target, countries=countries, sizes=sizes,
+                        deltas=deltas, **versions)
+
+
+def main():
+    makedirs(INDEX_FOLDER, exist_ok=True)
+    files = {}
+    for fname, field, year in source_files():
+        files.setdefault((field, year), []).append(fname)
+    print(f">>> Indexing authors of {len(files):,} field-years...")
+    print_progress(0, len(files))
+    for i, ((field, year), fnames) in enumerate(sorted(files.items())):
+        target = index_file(field, year)
+        if is_outdated(target, fnames):
+            index_authors(fnames, target)
+        print_progress(i+1, len(files))
+
+
+if __name__ == '__main__':
+    main()
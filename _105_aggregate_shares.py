@@ -8,15 +8,20 @@ the s bar-notation.
 from configparser import ConfigParser
 from glob import glob
 
+import numpy as np
 import pandas as pd
 
 from _002_sample_journals import write_stats
-from _100_parse_articles import print_progress
+from source_data import SOURCE_DTYPES, AuthorIndex, read_source_file,\
+    read_source_files, source_files
 
 JOURNAL_FOLDER = "./002_journal_samples/"
 TARGET_FOLDER = "./105_multiaff_shares/"
 OUTPUT_FOLDER = "./990_output/"
 
+STREAM_YEARS = False  # Aggregate one year at a time to bound memory use
+DISTINCT_ERROR = None  # Relative standard error of distinct counts, exact if None
+
 config = ConfigParser()
 config.optionxform = str
 config.read("./definitions.cfg")
@@ -24,48 +29,102 @@ _asjc_map = {int(k): v for k, v in dict(config["field names"]).items()}
 _groups = dict(config["country groups"])
 
 
-def aggregate(df, columns, aggs={"multiaff": ["size", sum], "foreignaff": sum},
-              totals=False):
-    """Compute multiaff share for unique observations via groupby."""
-    if totals:
-        tot = (df.drop_duplicates(["author", "year"])
-                 .groupby(["year"]).agg(aggs)
-                 .reset_index())
-        tot[('field', '')] = "All"
-    df = (df.drop_duplicates(["author", "year"] + columns)
-            .groupby(["year"] + columns).agg(aggs)
-            .reset_index())
-    if totals:
-        df = df.append(tot)
-    df.columns = [''.join(col) for col in df.columns]
-    df["multiaffshare"] = df["multiaffsum"]/df["multiaffsize"]*100
-    df["foreignaffshare"] = df["foreignaffsum"]/df["multiaffsum"]*100
-    return (df.rename(columns={"multiaffsize": "n_authors"})
-              .drop(["multiaffsum", "foreignaffsum"], axis=1))
+def aggregate(df, sets, aggs={"multiaff": ["size", sum], "foreignaff": sum}):
+    """Compute multiaff share for unique observations via groupby for each
+    list of columns in `sets`.
+
+    Unique observations of a set are taken from those of the last set
+    before it that includes its columns instead of from all rows.  This
+    keeps the first row of each observation as the order of rows is kept.
+    """
+    unique = {}
+    out = []
+    for columns in sets:
+        rows = df
+        for previous, reduced in unique.items():
+            if set(columns) <= set(previous):
+                rows = reduced
+        rows = rows.drop_duplicates(["author", "year"] + columns)
+        unique[tuple(columns)] = rows
+        res = rows.groupby(["year"] + columns).agg(aggs).reset_index()
+        res.columns = [''.join(col) for col in res.columns]
+        res["multiaffshare"] = res["multiaffsum"]/res["multiaffsize"]*100
+        res["foreignaffshare"] = res["foreignaffsum"]/res["multiaffsum"]*100
+        out.append(res.rename(columns={"multiaffsize": "n_authors"})
+                          .drop(["multiaffsum", "foreignaffsum"], axis=1))
+    return out
+
+
+class DistinctCounter:
+    """Counter of distinct values: a HyperLogLog sketch with relative
+    standard error `error`, or the exact set of values if `error` is None.
+    """
+
+    def __init__(self, error=None):
+        self.error = error
+        self.values = None
+        if error is not None:
+            precision = max(4, int(np.ceil(np.log2((1.04/error)**2))))
+            self.registers = np.zeros(1 << precision, dtype="uint8")
+
+    def update(self, values):
+        """Add non-missing `values` and return the counter."""
+        values = pd.Series(values).dropna().unique()
+        if self.error is None:
+            if self.values is not None:
+                values = np.union1d(self.values, values)
+            self.values = values
+            return self
+        # Bucket by first bits of hash, rank is position of first 1-bit
+        # among the remaining bits
+        hashes = pd.util.hash_array(np.asarray(values))
+        precision = self.registers.size.bit_length() - 1
+        rest = 64 - precision
+        bucket = (hashes >> np.uint64(rest)).astype(np.intp)
+        bits = hashes & np.uint64((1 << rest) - 1)
+        length = np.zeros(bits.shape, dtype="uint8")
+        for shift in (32, 16, 8, 4, 2, 1):
+            big = bits >= np.uint64(1 << shift)
+            length[big] += shift
+            bits = np.where(big, bits >> np.uint64(shift), bits)
+        length += (bits > 0).astype("uint8")
+        np.maximum.at(self.registers, bucket, rest - length + 1)
+        return self
+
+    def count(self):
+        """Return the (estimated) number of distinct values."""
+        if self.error is None:
+            return 0 if self.values is None else len(self.values)
+        m = self.registers.size
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213/(1 + 1.079/m))
+        estimate = (alpha * m**2
+                    / np.sum(np.ldexp(1.0, -self.registers.astype(int))))
+        empty = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5*m and empty:
+            estimate = m*np.log(m/empty)  # Linear counting for small sets
+        return int(round(estimate))
 
 
 def count_unique(data):
-    """Count the number of unique elements."""
-    return data.nunique()
+    """Count unique values, approximately if DISTINCT_ERROR is set."""
+    return DistinctCounter(DISTINCT_ERROR).update(data).count()
 
 
-def make_articles_shares_table(df, fname, byvar):
+def count_articles(df, byvar):
+    """Count articles and MA articles by `byvar` and year."""
+    df = (df.groupby(["year", byvar, "eid"])["multiaff"].max()
+            .reset_index())
+    return df.groupby([byvar, "year"])["multiaff"].agg(["sum", "count"])
+
+
+def make_articles_shares_table(counts, fname, byvar):
     """Create and write out Latex-formated table on shares by
     field over time.
     """
-    # Aggregate information at observational level
-    df = (df.sort_values("multiaff", ascending=False)
-            .groupby(["year", byvar, "eid"])["multiaff"].max()
-            .reset_index())
     # Aggregate information at field-year level (for totals)
-    grouped = df.groupby([byvar, "year"])["multiaff"]
-    out = grouped.sum().to_frame()
-    out["share"] = (out["multiaff"]/grouped.count())*100
-    del grouped
-    out = (out.reset_index()
-              .drop("multiaff", axis=1)
-              .pivot(columns=byvar, values="share", index="year"))
-    overall = df.groupby(["year"])["multiaff"].agg(["sum", "count"])
+    out = (counts["sum"]/counts["count"]*100).rename("share").reset_index()
+    out = out.pivot(columns=byvar, values="share", index="year")
+    overall = counts.groupby(level="year").sum()
     # Rename and sort columns
     out.columns = [_asjc_map.get(c, c) for c in out.columns]
     out = out[sorted(out.columns)]
@@ -76,59 +135,102 @@ def make_articles_shares_table(df, fname, byvar):
     out.T.to_latex(fname, escape=False, index_names=False, float_format="%.2f")
 
 
-def read_source_files(cols, drop_duplicates=None, **pd_kwds):
-    """Read files from SOURCE_FOLDER."""
-    from glob import glob
-    from os.path import basename, splitext
-
-    df = []
-    files = glob("./100_source_articles/*.csv")
-    total = len(files)
-    print(">>> Reading files...")
-    print_progress(0, total)
-    for idx, f in enumerate(files):
-        new = pd.read_csv(f, usecols=cols, encoding="utf8", **pd_kwds)
-        if drop_duplicates:
-            new = new.drop_duplicates(subset=drop_duplicates)
-        name_parts = splitext(basename(f))[0].split("_")[1].split("-")
-        new["field"] = int(name_parts[0])
-        new["year"] = int(name_parts[1])
-        df.append(new)
-        print_progress(idx+1, total)
-    df = pd.concat(df)
-    print(">>> Optimizing dtypes")
-    for c in ("year", "field"):
-        df[c] = df[c].astype("uint32")
-    print(">>> Reading done")
-    return df
+def read_chunks(cols, dtype=None):
+    """Yield all source files at once, or one year at a time if
+    STREAM_YEARS with the categories of all years.
+    """
+    if not STREAM_YEARS:
+        yield read_source_files(cols, dtype=dtype)
+        return
+    dtype = {**SOURCE_DTYPES, **(dtype or {})}
+    files = source_files()
+    categories = {c: set() for c in cols if dtype.get(c) == "category"}
+    for fname, _, _ in files:
+        df = read_source_file(fname, list(categories),
+                              dtype={c: "category" for c in categories})
+        for c in categories:
+            categories[c].update(df[c].cat.categories)
+    for year in sorted({y for _, _, y in files}):
+        print(f">>> Year {year}")
+        df = read_source_files(cols, years=[year], dtype=dtype)
+        for c, values in categories.items():
+            df[c] = df[c].cat.set_categories(sorted(values))
+        yield df
 
 
 def main():
-    # Read articles list
-    cols = ["author_count", "countries", "source_id", "eid", "author"]
-    dtypes = {"author_count": "uint8", "author": "uint64", "source_id": "uint64"}
-    df = read_source_files(cols, dtype=dtypes)
-    print(">>> Computing paper status")
-    df["countries"] = df["countries"].str.split("-")
-    df["multiaff"] = (df["countries"].str.len() > 1).astype("uint32")
-    df["foreignaff"] = (df["countries"].apply(set).str.len() > 1).astype("uint32")
-    df["countries"] = df["countries"].str[0].astype("category")
-    df = df.rename(columns={"countries": "country"})
-    df = df.sort_values("multiaff", ascending=False)
-    dedup = df.drop_duplicates(["author", "eid"])
-    n_ma_obs = dedup["multiaff"].sum()
-    n_fa_obs = dedup["foreignaff"].sum()
+    jour = pd.concat([pd.read_csv(f, usecols=["Sourceid", "octile"]) for f in
+                      glob(JOURNAL_FOLDER + "[0-9][0-9].csv")])
+    jour = (jour.sort_values("octile", ascending=False)
+                .drop_duplicates(["Sourceid"]))
+    labels = ["byquality", "bycountry", "bycountryfield", "byfield"]
+
+    # Read articles list, and accumulate counts and aggregates which are
+    # exact across years as articles belong to one year only
+    cols = ["author_count", "source_id", "eid", "author", "multiaff",
+            "foreignaff", "country"]
+    dtypes = {"author_count": "uint16", "author": "uint64", "source_id": "uint64",
+              "multiaff": "uint32", "foreignaff": "uint32"}
+    n_obs = n_ma_obs = n_fa_obs = n_articles = 0
+    articles = []
+    field_counts = []
+    moments = np.zeros(6)
+    totals = []
+    counts = []
+    parts = {label: [] for label in labels}
+    for df in read_chunks(cols, dtypes):
+        # The foreign flag of an author-year is that of its first MA row;
+        # a stable sort keeps the same row whether years are streamed or not
+        df = df.sort_values("multiaff", ascending=False, kind="stable")
+        dedup = df.drop_duplicates(["author", "eid"])
+        n_obs += dedup.shape[0]
+        n_ma_obs += dedup["multiaff"].sum()
+        n_fa_obs += dedup["foreignaff"].sum()
+        del dedup
+        n_articles += count_unique(df['eid'])
+        # Unique articles by country
+        articles.append(df.groupby(["country"])["eid"].agg(count_unique))
+
+        # Articles by field
+        field_counts.append(count_articles(df, byvar="field"))
+
+        # Articles by year
+        paper = (df.groupby(["year", "eid"])[["author_count", "multiaff"]].max()
+                   .reset_index().drop("eid", axis=1))
+        df = df.drop("author_count", axis=1)
+        x = paper["author_count"].to_numpy(dtype="float64")
+        y = paper["multiaff"].to_numpy(dtype="float64")
+        moments += [x.size, x.sum(), y.sum(), (x*x).sum(), (y*y).sum(), (x*y).sum()]
+        totals.append(paper["year"].value_counts())
+        counts.append(paper.groupby("year")[["multiaff"]].sum()["multiaff"])
+        del paper
+
+        # Aggregate by journal quality, country and field
+        quality = (df.merge(jour, "inner", left_on="source_id", right_on="Sourceid")
+                     .drop(["field", "Sourceid", "source_id", "country", "eid"], axis=1)
+                     .sort_values(["octile", "multiaff"], ascending=False))
+        parts["byquality"].extend(aggregate(quality, [["octile"]]))
+        del quality
+        # Fields are named after aggregation, on few rows
+        sets = [["country", "field"], ["country"], ["field"], []]
+        bycountryfield, bycountry, byfield, total = aggregate(df, sets)
+        del df
+        total["field"] = "All"
+        parts["bycountry"].append(bycountry)
+        parts["bycountryfield"].append(bycountryfield)
+        parts["byfield"].append(pd.concat([byfield, total], ignore_index=True))
     print(f">>> Found {n_ma_obs:,} author-article obs. with MA "
-          f"({n_ma_obs/dedup.shape[0]:.2%} of all), of which {n_fa_obs:,} "
+          f"({n_ma_obs/n_obs:.2%} of all), of which {n_fa_obs:,} "
           f"({n_fa_obs/n_ma_obs:.2%}) contain a foreign affiliation")
-    del dedup
-    stats = {"N_of_authors_unique": df["author"].nunique(),
-             "N_of_articles_unique": df['eid'].nunique()}
+    index = AuthorIndex()
+    stats = {"N_of_authors_unique": index.authors().size,
+             "N_of_articles_unique": n_articles}
 
     # LaTeX table on papers and authors by country
-    grouped = df.groupby(["country"]).agg(
-        Articles=pd.NamedAgg(column='eid', aggfunc=count_unique),
-        Authors=pd.NamedAgg(column='author', aggfunc=count_unique))
+    grouped = pd.concat(articles).groupby(level=0).sum().to_frame("Articles")
+    grouped["Authors"] = [index.authors(countries=[c]).size
+                          for c in grouped.index]
+    del articles, index
     cols = grouped.columns
     mult_cols = [(c, "Unique") for c in cols]
     grouped.columns = pd.MultiIndex.from_tuples(mult_cols)
@@ -149,34 +251,25 @@ def main():
     # Create table on share of MA articles by field over time
     print(">>> Table articles by field")
     fname = OUTPUT_FOLDER + "Tables/multiaff_articles_share-field.tex"
-    make_articles_shares_table(df, fname, byvar="field")
+    make_articles_shares_table(pd.concat(field_counts), fname, byvar="field")
 
     # Compute some aggregates
-    paper = (df.groupby(["year", "eid"])["author_count", "multiaff"].max()
-               .reset_index().drop("eid", axis=1))
-    df = df.drop("author_count", axis=1)
-    print(">>> Correlation group size and MA author incidence: "
-          f"{paper[['author_count', 'multiaff']].corr().iloc[1, 0]:.2}")
-    print(">>> Share articles overall with MA author(s): "
-          f"{paper['multiaff'].sum()/paper.shape[0]:.2%}")
-    totals = paper["year"].value_counts()
-    counts = paper.groupby("year")[["multiaff"]].sum()["multiaff"]
+    n, sx, sy, sxx, syy, sxy = moments
+    corr = (n*sxy - sx*sy)/np.sqrt((n*sxx - sx**2)*(n*syy - sy**2))
+    print(f">>> Correlation group size and MA author incidence: {corr:.2}")
+    print(f">>> Share articles overall with MA author(s): {sy/n:.2%}")
+    totals = pd.concat(totals)
+    counts = pd.concat(counts)
     print(">>> Share of articles w/ MA author by year")
     print((counts/totals*100).round(4))
-    del counts, totals, paper
+    del counts, totals
+    aggregated = {label: pd.concat(frames, ignore_index=True)
+                  for label, frames in parts.items()}
+    del jour, parts
 
     # Observation is author-octile-year
     print(">>> File byquality")
-    jour = pd.concat([pd.read_csv(f, usecols=["Sourceid", "octile"]) for f in
-                      glob(JOURNAL_FOLDER + "[0-9][0-9].csv")])
-    jour = (jour.sort_values("octile", ascending=False)
-                .drop_duplicates(["Sourceid"]))
-    quality = (df.merge(jour, "inner", left_on="source_id", right_on="Sourceid")
-                 .drop(["field", "Sourceid", "source_id", "country", "eid"], axis=1)
-                 .sort_values(["octile", "multiaff"], ascending=False))
-    del jour
-    byquality = aggregate(quality, ["octile"])
-    del quality
+    byquality = aggregated.pop("byquality")
     oct_labels = {8: "Top", 7: "Second", 6: "Third", 5: "Fourth"}
     byquality["octile"] = byquality["octile"].replace(oct_labels)
     byquality = byquality.rename(columns={"octile": "Journal quality group"})
@@ -187,7 +280,7 @@ def main():
 
     # Observation is author-country-year
     print(">>> File bycountry")
-    bycountry = aggregate(df, ["country"])
+    bycountry = aggregated.pop("bycountry")
     fname = TARGET_FOLDER + "bycountry.csv"
     bycountry.to_csv(fname, float_format='%g', index=False, encoding="utf8")
     stats["N_of_authorcountryyear"] = bycountry["n_authors"].sum()
@@ -195,8 +288,10 @@ def main():
 
     # Observation is author-countryfield-year
     print(">>> File bycountryfield")
-    df["field"] = df["field"].replace(_asjc_map)
-    bycountryfield = aggregate(df, ["country", "field"])
+    bycountryfield = aggregated.pop("bycountryfield")
+    bycountryfield["field"] = bycountryfield["field"].replace(_asjc_map)
+    bycountryfield = bycountryfield.sort_values(["year", "country", "field"],
+                                                kind="stable")
     fname = TARGET_FOLDER + "bycountryfield.csv"
     bycountryfield.to_csv(fname, float_format='%g', index=False, encoding="utf8")
     stats["N_of_authorcountryfieldyear"] = bycountryfield["n_authors"].sum()
@@ -204,7 +299,8 @@ def main():
 
     # Observation is author-field-year
     print(">>> File byfield")
-    byfield = aggregate(df, ["field"], totals=True)
+    byfield = aggregated.pop("byfield")
+    byfield["field"] = byfield["field"].replace(_asjc_map)
     byfield = byfield.sort_values(["field", "year"])
     fname = TARGET_FOLDER + "byfield.csv"
     byfield.to_csv(fname, float_format='%g', index=False, encoding="utf8")
@@ -4,25 +4,26 @@
 
 from collections import Counter
 from configparser import ConfigParser
-from glob import glob
-from itertools import combinations
 from random import sample
 
 import matplotlib
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import seaborn as sns
-from pybliometrics.scopus import ContentAffiliationRetrieval
 from pybliometrics.scopus.exception import Scopus404Error
 
-from _100_parse_articles import START, END
-from _105_aggregate_shares import print_progress
+from _100_parse_articles import START, END, get_name
+from scopus_backend import ContentAffiliationRetrieval
+from source_data import print_progress, read_source_file, source_files
 
-SOURCE_FOLDER = "./100_source_articles/"
 TARGET_FOLDER = "./110_affiliation_rankings/"
 OUTPUT_FOLDER = "./990_output/"
 
 RANK_CUTOFF = 4  # Number of highest ranked affiliations for plot
+EXACT_RANKINGS = True  # Write complete rankings, else estimate top TOP_K
+TOP_K = 1000  # Length of estimated rankings
+CHUNK_SIZE = 100_000  # Observations counted at once for estimated rankings
 
 matplotlib.use('Agg')
 config = ConfigParser()
@@ -56,28 +57,92 @@ def format_time_axis(ax, _min, _max, labels=False, length=4):
 def read_ma_source_file(f):
     """Read MA observations of source files."""
     cols = ['affiliations', "eid", "author"]
-    df = pd.read_csv(f, encoding="utf8", usecols=cols)
+    df = read_source_file(f, cols)
     df["affiliations"] = df["affiliations"].str.split(";")
     return df[df["affiliations"].str.len() > 1]
 
 
-def select_and_write(counted):
+def count_pairs(affiliations):
+    """Count pairs of affiliations listed together, in order of first
+    occurrence.
+
+    Each pair of affiliation codes is encoded as one integer such that
+    counting is a histogram over integers.
+    """
+    sizes = affiliations.str.len().to_numpy()
+    codes, uniques = pd.factorize(affiliations.explode().to_numpy(), sort=True)
+    starts = np.cumsum(sizes) - sizes
+    n_pairs = sizes*(sizes-1)//2
+    offsets = np.cumsum(n_pairs) - n_pairs
+    first = np.empty(n_pairs.sum(), dtype="int64")
+    second = np.empty(n_pairs.sum(), dtype="int64")
+    # Pairs of positions in the order of itertools.combinations
+    for n in np.unique(sizes):
+        rows = np.flatnonzero(sizes == n)
+        i, j = np.triu_indices(n, k=1)
+        pos = offsets[rows][:, None] + np.arange(i.size)
+        first[pos] = codes[starts[rows][:, None] + i]
+        second[pos] = codes[starts[rows][:, None] + j]
+    # Codes are sorted like affiliation IDs
+    pairs = np.minimum(first, second)*len(uniques) + np.maximum(first, second)
+    labels, pairs = pd.factorize(pairs)
+    index = pd.MultiIndex(levels=[uniques, uniques],
+                          codes=[pairs // len(uniques), pairs % len(uniques)],
+                          names=["aff_id1", "aff_id2"])
+    return pd.Series(np.bincount(labels), index=index)
+
+
+class SpaceSaving:
+    """Space-Saving summary of the `size` most frequent items of a stream
+    in fixed memory.
+
+    Estimated counts exceed true counts by at most their error, which is
+    at most the length of the stream divided by `size`, and every item
+    occurring more often than that is in the summary.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.counts = pd.Series(dtype="int64")
+        self.errors = pd.Series(dtype="int64")
+
+    def update(self, counts):
+        """Add exact `counts` by item of the next part of the stream."""
+        if self.counts.empty:
+            # Take the index type of the items
+            self.counts = self.errors = counts.iloc[:0].astype("int64")
+        floor = self.counts.min() if len(self.counts) == self.size else 0
+        merged = self.counts.add(counts, fill_value=0).astype("int64")
+        errors = self.errors.reindex(merged.index)
+        # Items not in the summary may have been evicted with count floor
+        new = errors.isna()
+        merged[new] += floor
+        errors[new] = floor
+        keep = merged.nlargest(self.size).index
+        self.counts = merged[keep]
+        self.errors = errors[keep].astype("int64")
+
+    def to_frame(self):
+        """Return estimated counts as occurrence with their max_error."""
+        return pd.DataFrame({"occurrence": self.counts,
+                             "max_error": self.errors})
+
+
+def select_and_write(counted, label):
     """Select yearly top occurrences and write out ranking files."""
     top = set()
     for year, data in counted.items():
-        df = pd.DataFrame.from_dict(data, orient="index")
-        df.columns = ["occurrence"]
-        df = df.sort_values("occurrence", ascending=False)
-        top.update(df.head(RANK_CUTOFF).index)
-        if isinstance(df.iloc[0].name, tuple):
-            label = "pair"
-            df.index = pd.MultiIndex.from_tuples(df.index)
-            rename = {"level_0": "aff_id1", "level_1": "aff_id2"}
-            df = (df.reset_index().rename(columns=rename)
-                    .set_index(list(rename.values())))
+        if isinstance(data, SpaceSaving):
+            df = data.to_frame()
+        elif isinstance(data, pd.Series):
+            df = data.to_frame("occurrence")
         else:
-            label = "indiv"
+            df = pd.DataFrame.from_dict(data, orient="index")
+            df.columns = ["occurrence"]
+        if label == "indiv":
             df.index.name = "aff_id"
+        df = df.sort_values("occurrence", ascending=False)
+        top.update(df.head(RANK_CUTOFF).index)
         fname = f"{TARGET_FOLDER}{label}_{year}.csv"
         df.to_csv(fname)
     return top
@@ -87,43 +152,50 @@ def main():
     # Count affiliations
     indiv_counts = {}
     pair_counts = {}
+    all_afids = set()
     totals = pd.Series(dtype="uint64", name="n_obs")
     print(">>> Counting affiliations from source files year-wise...")
     years = range(START, END+1)
     print_progress(0, len(years))
     for i, year in enumerate(years):
         # Read files by year
-        files = glob(f"{SOURCE_FOLDER}*{year}*.csv")
-        df = pd.concat([read_ma_source_file(f) for f in files])
+        files = source_files(years=[year])
+        df = pd.concat([read_ma_source_file(f) for f, _, _ in files])
         dup_cols = ["eid", "author"]
         df = df.drop_duplicates(subset=dup_cols).drop(dup_cols, axis=1)
         totals.loc[year] = df.shape[0]
-        indiv_counts[year] = Counter([a for sl in df["affiliations"] for a in sl])
-        pairs = [combinations(sl, 2) for sl in df["affiliations"]]
-        pair_counts[year] = Counter([tuple(sorted(p)) for sl in pairs for p in sl])
+        all_afids.update(df["affiliations"].explode())
+        if EXACT_RANKINGS:
+            indiv_counts[year] = Counter([a for sl in df["affiliations"] for a in sl])
+            pair_counts[year] = count_pairs(df["affiliations"])
+        else:
+            indiv_counts[year] = SpaceSaving(TOP_K)
+            pair_counts[year] = SpaceSaving(TOP_K)
+            for start in range(0, df.shape[0], CHUNK_SIZE):
+                chunk = df["affiliations"].iloc[start:start+CHUNK_SIZE]
+                indiv_counts[year].update(chunk.explode().value_counts())
+                pair_counts[year].update(count_pairs(chunk))
         print_progress(i+1, len(years))
         del df
 
     # Write yearly rankings
     print(">>> Writing yearly rankings...")
-    tops_indiv = select_and_write(indiv_counts)
-    tops_pairs = select_and_write(pair_counts)
+    tops_indiv = select_and_write(indiv_counts, "indiv")
+    tops_pairs = select_and_write(pair_counts, "pair")
     for aff1, aff2 in tops_pairs:
-        name1 = ContentAffiliationRetrieval(aff1).affiliation_name
-        name2 = ContentAffiliationRetrieval(aff2).affiliation_name
-        print(name1, "--", name2)
+        print(get_name(aff1), "--", get_name(aff2))
 
     # Collect data for plotting
     print(f">>> Plotting {len(tops_indiv)} affiliations")
     df = pd.DataFrame()
-    all_afids = set()
     for year, data in indiv_counts.items():
-        new = pd.DataFrame.from_dict(data, orient="index")
-        all_afids.update(new.index)
+        if isinstance(data, SpaceSaving):
+            new = data.counts.to_frame(0)
+        else:
+            new = pd.DataFrame.from_dict(data, orient="index")
         new["year"] = year
         df = df.append(new.reindex(tops_indiv))
-    info = {aff_id: ContentAffiliationRetrieval(aff_id).affiliation_name
-            for aff_id in tops_indiv}
+    info = {aff_id: get_name(aff_id) for aff_id in tops_indiv}
     df["affiliation"] = pd.Series(info)
     df = (df.rename(columns={0: "occurrence"})
             .merge(totals, left_on="year", right_index=True))
@@ -4,23 +4,20 @@
 """Creates matrices showing country linkages."""
 
 from collections import defaultdict
-from glob import glob
 
 import pandas as pd
 
 from _100_parse_articles import START, END
+from source_data import read_source_file, source_files
 
-SOURCE_FOLDER = "./100_source_articles/"
 TARGET_FOLDER = "./120_country_matrices/"
 COUNTRY_WHITELIST = "./098_country_whitelist/oecd_others.csv"
 
 
 def read_ma_source_file(f):
     """Read MA observations of source files."""
-    cols = ['affiliations', 'countries', "author"]
-    df = pd.read_csv(f, encoding="utf8", usecols=cols)
-    df["ma"] = (df["affiliations"].str.find(";") != -1).astype("uint8")
-    df = (df.drop("affiliations", axis=1)
+    cols = ['countries', "author", "multiaff"]
+    df = (read_source_file(f, cols).rename(columns={"multiaff": "ma"})
             .sort_values("ma", ascending=False))
     return df.drop_duplicates("author")
 
@@ -32,8 +29,8 @@ def main():
     for year in range(START, END+1):
         print(f"... {year}")
         # Read files for current year and deduplicate
-        files = glob(f"{SOURCE_FOLDER}*{year}*.csv")
-        df = pd.concat([read_ma_source_file(f) for f in files])
+        files = source_files(years=[year])
+        df = pd.concat([read_ma_source_file(f) for f, _, _ in files])
         df = (df.sort_values("ma", ascending=False)
                 .drop_duplicates("author")
                 .drop("ma", axis=1))
@@ -14,9 +14,9 @@ import pandas as pd
 import seaborn as sns
 from numpy import nan
 
-from _105_aggregate_shares import read_source_files
 from _110_rank_affiliations import format_time_axis
 from _910_analyze_multiaff_shares import add_figure_letter
+from source_data import read_source_files
 
 SOURCE_FOLDER = "./100_source_articles/"
 OUTPUT_FOLDER = "./990_output/"
@@ -43,27 +43,6 @@ def aggregate_shares(df):
               .rename(columns={0: "count"}))
 
 
-def clean_types(type_str):
-    """Reduce multiple combinations of the same type to a dual combination."""
-    names = {"univ": "Univ.", "resi": "Res. Inst.", "comp": "Company",
-             "hosp": "Hospital", "govt": "Gov.", "ngov": "Non-Gov.",
-             "?": "Unknown"}
-    if "-" not in type_str:
-        return names.get(type_str, type_str)
-    types = {names.get(t, t) for t in set(type_str.split("-"))}
-    if len(types) == 1:
-        t = types.pop()
-        if t == "Unknown":
-            return "Other"
-        return f"{t}-{t}"
-    else:
-        types = sorted(types, reverse=True)
-        if types[0] == "Unknown":
-            types.pop(0)
-            types.append("Unknown")
-        return "-".join(types)
-
-
 def collapse_rare_combinations(df, thres):
     """Replace rare combinations with 'Other' except when it' common once."""
     common_combs = set(df[df["share"] >= thres]["types"].unique())
@@ -178,12 +157,11 @@ def sort_df(df, col=2019, ascending=False):
 
 def main():
     # Read in
-    df = read_source_files(["types", "author"], verbose=False)
-    df["multiaff"] = (df["types"].str.find("-") > -1).astype("uint32")
+    df = read_source_files(["author", "multiaff", "combination"])
     df = (df.sort_values("multiaff", ascending=False)
             .drop_duplicates(subset=["author", "field", "year"])
-            .rename(columns={"year": "Year"}))
-    df["types"] = df["types"].apply(clean_types)
+            .rename(columns={"year": "Year", "combination": "types"}))
+    df["types"] = df["types"].astype(object)
     multi = df[df["multiaff"] == 1].copy()
 
     # Table on shares of particular MA combinations
@@ -10,8 +10,8 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 
 from _002_sample_journals import write_stats
-from _105_aggregate_shares import read_source_files
 from _110_rank_affiliations import format_time_axis
+from source_data import read_source_files
 
 SOURCE_FOLDER = "./100_source_articles/"
 OUTPUT_FOLDER = "./990_output/"
@@ -75,13 +75,12 @@ def make_shares_table(fname, df):
 
 def main():
     # Read in
-    dtypes = {"author_count": "uint8"}
-    df = read_source_files(["eid", "author_count", "affiliations"],
+    dtypes = {"author_count": "uint16"}
+    df = read_source_files(["eid", "author_count", "multiaff"],
                            drop_duplicates=["eid"], dtype=dtypes)
     write_stats({"N_of_authorpaper": df.shape[0]})
     df["solo"] = (df["author_count"] == 1)*1
-    df["multiaff"] = (df["affiliations"].str.find(";") != -1).astype("uint8")
-    df = df.drop(["affiliations", "author_count"], axis=1)
+    df = df.drop("author_count", axis=1)
 
     # Graph with shares
     fname = OUTPUT_FOLDER + "Figures/solo-multiaff_shares-paper-all.pdf"
@@ -3,14 +3,13 @@
 """Describe raw data used and share of useable papers."""
 
 from configparser import ConfigParser
-from glob import glob
 
 import pandas as pd
 
 from _910_analyze_multiaff_shares import make_stacked_lineplot
+from source_data import AuthorIndex
 
 JOURNAL_FOLDER = "./002_journal_samples/"
-SOURCE_FOLDER = "./100_source_articles/"
 COUNTS_FOLDER = "./100_meta_counts/"
 OUTPUT_FOLDER = "./990_output/"
 
@@ -42,13 +41,10 @@ def read_from_statistics(fname):
 
 def main():
     # Compute number of authors by field
+    index = AuthorIndex()
     author_counts = pd.Series(dtype="uint64")
     for field in asjc_map.keys():
-        authors = set()
-        for f in glob(f"{SOURCE_FOLDER}articles_{field}-*.csv"):
-            df = pd.read_csv(f, encoding="utf8", usecols=["author"])
-            authors.update(df["author"].unique())
-        author_counts[field] = len(authors)
+        author_counts[field] = index.authors(fields=[int(field)]).size
 
     # LaTeX table with authors and papers by field
     fname = JOURNAL_FOLDER + "journal-counts.csv"
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# Author:   Michael E. Rose <michael.ernst.rose@gmail.com>
+"""Runs the Python scripts of the pipeline in dependency order.
+
+Stages whose input files and code have not changed since their last
+successful run are skipped, and independent stages run concurrently.
+"""
+
+import json
+import os
+import re
+import subprocess
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from glob import glob
+from hashlib import sha1
+from time import perf_counter
+
+STATE_FILE = "./.pipeline_state.json"
+LOG_FOLDER = "./pipeline_logs/"
+SESSION_TIMES = LOG_FOLDER + "session_times.json"  # Times of session stages
+
+MAX_PARALLEL = 3  # Number of stages running at the same time
+SESSION = "session"  # Name of the stage running the session stages
+
+SOURCES = ["100_source_articles/*.csv", "100_source_dataset/*/*/*.parquet"]
+FLAGS = ["101_article_flags/*.*"]
+INDEX = ["102_author_index/*.npz"]
+SAMPLES = ["002_journal_samples/[0-9][0-9].csv"]
+WHITELIST = ["098_country_whitelist/*.csv"]
+CONFIGS = ["definitions.cfg", "graphs.cfg"]
+
+# Stages by script with the stages they run after, the files they read
+# and the files they write
+STAGES = {
+    "_002_sample_journals": {
+        "after": [],
+        "inputs": ["000_journal_rankings/*", "001_journal_coverage/*.csv"]
+                  + CONFIGS,
+        "outputs": SAMPLES + ["002_journal_samples/journal-counts.csv"]},
+    "_100_parse_articles": {
+        "after": ["_002_sample_journals"],
+        "inputs": SAMPLES + WHITELIST + ["095_affiliation_correction/*.csv",
+                                         "097_affiliation_blacklist/*.csv"]
+                  + CONFIGS,
+        "outputs": SOURCES[:1] + ["100_meta_counts/num_*.csv"]},
+    "_101_enrich_articles": {
+        "after": ["_100_parse_articles"],
+        "inputs": SOURCES,
+        "outputs": FLAGS},
+    "_102_index_authors": {
+        "after": ["_101_enrich_articles"],
+        "inputs": SOURCES + FLAGS,
+        "outputs": INDEX},
+    "_105_aggregate_shares": {
+        "after": ["_002_sample_journals", "_102_index_authors"],
+        "inputs": SOURCES + FLAGS + INDEX + SAMPLES + CONFIGS,
+        "outputs": ["105_multiaff_shares/by*.csv",
+                    "990_output/Statistics/N_of_a*.txt"]},
+    "_110_rank_affiliations": {
+        "after": ["_100_parse_articles"],
+        "inputs": SOURCES + CONFIGS,
+        "outputs": ["110_affiliation_rankings/*_[0-9]*.csv",
+                    "990_output/Figures/top-affs.pdf"]},
+    "_120_make_country_links": {
+        "after": ["_101_enrich_articles"],
+        "inputs": SOURCES + FLAGS + WHITELIST,
+        "outputs": ["120_country_matrices/*.csv"]},
+    "_910_analyze_multiaff_shares": {
+        "after": ["_105_aggregate_shares"],
+        "inputs": ["105_multiaff_shares/by*.csv"] + WHITELIST + CONFIGS,
+        "outputs": ["990_output/Figures/multiaff_global.pdf"]},
+    "_915_analyze_exin_countries": {
+        "after": ["_105_aggregate_shares"],
+        "inputs": ["105_multiaff_shares/by*.csv"] + WHITELIST + CONFIGS,
+        "outputs": ["990_output/Tables/multiaff_groups-*.tex"]},
+    "_920_plot_foreign_partners": {
+        "after": ["_105_aggregate_shares", "_120_make_country_links"],
+        "inputs": ["105_multiaff_shares/bycountry.csv",
+                   "120_country_matrices/*.csv"] + CONFIGS,
+        "outputs": ["990_output/Figures/network_*.pdf"]},
+    "_930_analyze_combinations": {
+        "after": ["_101_enrich_articles"],
+        "inputs": SOURCES + FLAGS + CONFIGS,
+        "outputs": ["990_output/Tables/combs_share-*.tex"]},
+    "_940_analyze_solo_papers": {
+        "after": ["_101_enrich_articles"],
+        "inputs": SOURCES + FLAGS + CONFIGS,
+        "outputs": ["990_output/Tables/solo_shares-paper-all.tex"]},
+    "_950_describe_usable_articles": {
+        "after": ["_002_sample_journals", "_102_index_authors",
+                  "_105_aggregate_shares"],
+        "inputs": SOURCES + FLAGS + INDEX
+                  + ["002_journal_samples/journal-counts.csv",
+                     "100_meta_counts/num_*.csv",
+                     "990_output/Statistics/N_of_*_unique.txt",
+                     "990_output/Statistics/N_of_journals_*.txt"]
+                  + CONFIGS,
+        "outputs": ["990_output/Tables/overview_useable.tex"]},
+}
+# Stages reading source files, which in session mode run one after another
+# in a single process that loads the source files only once
+SESSION_STAGES = ["_102_index_authors", "_105_aggregate_shares",
+                  "_110_rank_affiliations", "_120_make_country_links",
+                  "_930_analyze_combinations", "_940_analyze_solo_papers"]
+
+
+class FileHashes:
+    """Content hashes of files, recomputed only when size or modification
+    time changed.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __call__(self, fname):
+        stat = os.stat(fname)
+        key = [stat.st_size, stat.st_mtime_ns]
+        try:
+            size, mtime, digest = self.cache[fname]
+            if [size, mtime] == key:
+                return digest
+        except KeyError:
+            pass
+        h = sha1()
+        with open(fname, "rb") as inf:
+            for block in iter(lambda: inf.read(1 << 20), b""):
+                h.update(block)
+        self.cache[fname] = key + [h.hexdigest()]
+        return h.hexdigest()
+
+
+def code_files(script):
+    """Return the script and all local modules it imports, recursively."""
+    files = [script]
+    for fname in files:
+        with open(fname, encoding="utf8") as inf:
+            src = inf.read()
+        for module in re.findall(r"^from (_\d+\w*|scopus_backend|source_data) import",
+                                 src, flags=re.M):
+            if f"{module}.py" not in files:
+                files.append(f"{module}.py")
+    return files
+
+
+def stage_digest(name, hashes):
+    """Hash the code and input files of a stage."""
+    h = sha1()
+    files = code_files(f"{name}.py")
+    for pattern in STAGES[name]["inputs"]:
+        files.extend(sorted(glob(pattern)))
+    for fname in files:
+        h.update(f"{fname}:{hashes(fname)}\n".encode())
+    return h.hexdigest()
+
+
+def has_outputs(name):
+    """Whether every output pattern of a stage matches at least one file."""
+    return all(glob(pattern) for pattern in STAGES[name]["outputs"])
+
+
+def run_stage(name, members=None):
+    """Run the script of a stage, or the session with stages `members`,
+    logging its output, and return whether it succeeded as well as its
+    wall time.
+    """
+    if members:
+        code = ("from source_data import run_session; "
+                f"run_session({members!r}, {SESSION_TIMES!r})")
+        command = [sys.executable, "-c", code]
+    else:
+        command = [sys.executable, f"{name}.py"]
+    start = perf_counter()
+    with open(f"{LOG_FOLDER}{name}.log", "w", encoding="utf8") as log:
+        proc = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT)
+    return proc.returncode == 0, perf_counter() - start
+
+
+def write_state(state):
+    """Write state atomically."""
+    temp = STATE_FILE + ".tmp"
+    with open(temp, "w") as out:
+        json.dump(state, out, indent=1)
+    os.replace(temp, STATE_FILE)
+
+
+def is_current(name, digest, state, force):
+    """Whether a stage does not need to run."""
+    return not force and state["stages"].get(name) == digest and has_outputs(name)
+
+
+def main(stages, force=False, jobs=MAX_PARALLEL, session=False):
+    os.makedirs(LOG_FOLDER, exist_ok=True)
+    try:
+        with open(STATE_FILE) as inf:
+            state = json.load(inf)
+    except FileNotFoundError:
+        state = {"files": {}, "stages": {}}
+    hashes = FileHashes(state["files"])
+    # Build graph of nodes to run, with session stages merged into one
+    members = [s for s in SESSION_STAGES if s in stages] if session else []
+
+    def node(name):
+        return SESSION if name in members else name
+
+    graph = {}
+    for name in STAGES:
+        if name in stages:
+            after = {node(s) for s in STAGES[name]["after"] if s in stages}
+            graph.setdefault(node(name), set()).update(after - {node(name)})
+    pending = list(graph)
+    status = {}
+    times = {}
+    running = {}
+    start = perf_counter()
+    with ThreadPoolExecutor(jobs) as executor:
+        while pending or running:
+            # Start or skip all stages whose predecessors are finished
+            for name in list(pending):
+                after = graph[name]
+                if any(status.get(s) in ("failed", "blocked") for s in after):
+                    status[name] = "blocked"
+                elif any(status.get(s) is None for s in after):
+                    continue
+                elif len(running) >= jobs:
+                    break
+                elif name == SESSION:
+                    # Run stale members and those after stale members
+                    stale = []
+                    for member in members:
+                        digest = stage_digest(member, hashes)
+                        upstream = set(STAGES[member]["after"]) & set(stale)
+                        if upstream or not is_current(member, digest, state, force):
+                            stale.append(member)
+                        else:
+                            status[member] = "skipped"
+                            print(f">>> {member} is up to date")
+                    if stale:
+                        if os.path.exists(SESSION_TIMES):
+                            os.remove(SESSION_TIMES)
+                        print(f">>> Running {', '.join(stale)} in session...")
+                        future = executor.submit(run_stage, name, stale)
+                        running[future] = (name, stale)
+                    else:
+                        status[name] = "skipped"
+                else:
+                    digest = stage_digest(name, hashes)
+                    if is_current(name, digest, state, force):
+                        status[name] = "skipped"
+                        print(f">>> {name} is up to date")
+                    else:
+                        print(f">>> Running {name}...")
+                        future = executor.submit(run_stage, name)
+                        running[future] = (name, digest)
+                pending.remove(name)
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, digest = running.pop(future)
+                success, times[name] = future.result()
+                status[name] = "done" if success else "failed"
+                if name == SESSION:
+                    # Members with a time finished even if a later one
+                    # failed.  Hash members only now as earlier ones write
+                    # inputs of later ones
+                    try:
+                        with open(SESSION_TIMES) as inf:
+                            times.update(json.load(inf))
+                    except FileNotFoundError:
+                        pass
+                    for member in digest:
+                        status[member] = "done" if member in times else status[name]
+                        state["stages"].pop(member, None)
+                        if status[member] == "done":
+                            state["stages"][member] = stage_digest(member, hashes)
+                elif success:
+                    state["stages"][name] = digest
+                else:
+                    state["stages"].pop(name, None)
+                write_state(state)
+                print(f">>> {name} {status[name]} after {times[name]:.1f}s")
+    write_state(state)
+
+    # Report
+    print(f">>> Pipeline finished after {perf_counter() - start:.1f}s:")
+    for name in [*STAGES, SESSION]:
+        if name not in status:
+            continue
+        elapsed = f"{times[name]:9.1f}s" if name in times else " " * 10
+        print(f"    {name:<32}{status[name]:<9}{elapsed}")
+    failed = [n for n in times if status[n] == "failed"]
+    for name in failed:
+        print(f">>> See {LOG_FOLDER}{name}.log for the error of {name}")
+    return not failed
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("stages", nargs="*", default=list(STAGES),
+                        help="Scripts to run (default: all)")
+    parser.add_argument("--force", action="store_true",
+                        help="Run stages even if they are up to date")
+    parser.add_argument("--jobs", type=int, default=MAX_PARALLEL,
+                        help="Number of stages running at the same time")
+    parser.add_argument("--session", action="store_true",
+                        help="Run stages reading source files in one process "
+                             "that loads them only once")
+    args = parser.parse_args()
+    stages = [s[:-3] if s.endswith(".py") else s for s in args.stages]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"Unknown stages: {', '.join(sorted(unknown))}")
+    sys.exit(not main(stages, force=args.force, jobs=args.jobs,
+                      session=args.session))
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# Author:   Michael E. Rose <michael.ernst.rose@gmail.com>
+"""Provides the Scopus classes used by the crawl scripts, optionally
+recording responses into a fixture archive or replaying them offline.
+
+Select the backend via environment variable SCOPUS_BACKEND:
+- "live" (default): Query the Scopus API through pybliometrics.
+- "record": Query the Scopus API and store all responses in the archive.
+- "replay": Serve stored responses without network access, with injected
+   latency (SCOPUS_LATENCY, mean seconds per request), throttling errors
+   (SCOPUS_ERROR_RATE, share of requests) and corrupted search results
+   lacking a cover date (SCOPUS_CORRUPT_RATE, share of search requests).
+"""
+
+import json
+import os
+import re
+import sqlite3
+import zlib
+from collections import namedtuple
+from random import expovariate, random
+from threading import Lock
+from time import sleep
+from warnings import warn
+
+from pybliometrics.scopus import exception
+from pybliometrics.scopus import ContentAffiliationRetrieval as _LiveRetrieval
+from pybliometrics.scopus import ScopusSearch as _LiveSearch
+
+BACKEND = os.environ.get("SCOPUS_BACKEND", "live")
+FIXTURE_FILE = os.environ.get("SCOPUS_FIXTURES", "./scopus_fixtures.sqlite")
+LATENCY = float(os.environ.get("SCOPUS_LATENCY", 0))
+ERROR_RATE = float(os.environ.get("SCOPUS_ERROR_RATE", 0))
+CORRUPT_RATE = float(os.environ.get("SCOPUS_CORRUPT_RATE", 0))
+
+AFF_ATTRIBUTES = ("affiliation_name", "country", "org_type")
+
+
+class FixtureArchive:
+    """Thread-safe SQLite archive of Scopus responses."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._lock = Lock()
+        self._con = None
+
+    @property
+    def con(self):
+        """Connection shared by all threads, created on first use."""
+        if self._con is None:
+            self._con = sqlite3.connect(self.fname, timeout=60,
+                                        check_same_thread=False)
+            self._con.execute("CREATE TABLE IF NOT EXISTS searches (query "
+                              "TEXT PRIMARY KEY, fields TEXT, results BLOB)")
+            self._con.execute("CREATE TABLE IF NOT EXISTS documents (eid "
+                              "TEXT PRIMARY KEY, fields TEXT, record TEXT)")
+            self._con.execute("CREATE TABLE IF NOT EXISTS affiliations "
+                              "(aff_id TEXT PRIMARY KEY, data TEXT)")
+        return self._con
+
+    def get_search(self, query):
+        """Return recorded field names and results of a search query."""
+        with self._lock:
+            q = "SELECT fields, results FROM searches WHERE query = ?"
+            row = self.con.execute(q, (query,)).fetchone()
+        if row is None:
+            raise exception.Scopus404Error(f"No fixture for query {query}")
+        fields, blob = row
+        results = json.loads(zlib.decompress(blob)) if blob else None
+        return json.loads(fields), results
+
+    def get_documents(self, eids):
+        """Return field names and recorded documents with given EIDs."""
+        marks = ", ".join("?" * len(eids))
+        q = f"SELECT fields, record FROM documents WHERE eid IN ({marks})"
+        with self._lock:
+            rows = self.con.execute(q, eids).fetchall()
+        if not rows:
+            return [], None
+        return json.loads(rows[0][0]), [json.loads(r[1]) for r in rows]
+
+    def put_search(self, query, results):
+        """Store results of a search query."""
+        fields = list(results[0]._fields) if results else []
+        blob = None
+        if results:
+            blob = zlib.compress(json.dumps([list(r) for r in results]).encode())
+        docs = [(r.eid, json.dumps(fields), json.dumps(list(r)))
+                for r in results or [] if getattr(r, "eid", None)]
+        with self._lock:
+            self.con.execute("INSERT OR REPLACE INTO searches VALUES (?, ?, ?)",
+                             (query, json.dumps(fields), blob))
+            self.con.executemany("INSERT OR REPLACE INTO documents VALUES "
+                                 "(?, ?, ?)", docs)
+            self.con.commit()
+
+    def get_affiliation(self, aff_id):
+        """Return recorded attributes or error of an affiliation."""
+        with self._lock:
+            q = "SELECT data FROM affiliations WHERE aff_id = ?"
+            row = self.con.execute(q, (aff_id,)).fetchone()
+        if row is None:
+            raise exception.Scopus404Error(f"No fixture for affiliation {aff_id}")
+        return json.loads(row[0])
+
+    def put_affiliation(self, aff_id, data):
+        """Store attributes or error of an affiliation."""
+        with self._lock:
+            self.con.execute("INSERT OR REPLACE INTO affiliations VALUES (?, ?)",
+                             (aff_id, json.dumps(data)))
+            self.con.commit()
+
+
+_archive = FixtureArchive(FIXTURE_FILE)
+
+
+def check_integrity(results, fields, action="raise"):
+    """Raise AttributeError or warn like pybliometrics if a field is
+    missing.
+    """
+    for field in fields or ():
+        if any(getattr(r, field) is None for r in results):
+            msg = f"Results for field {field} incomplete"
+            if action == "warn":
+                warn(msg)
+            else:
+                raise AttributeError(msg)
+
+
+def simulate_request():
+    """Wait for injected latency and raise injected throttling errors."""
+    if LATENCY:
+        sleep(expovariate(1/LATENCY))
+    if random() < ERROR_RATE:
+        raise exception.Scopus429Error("Injected quota exceeded")
+
+
+class RecordingScopusSearch:
+    """ScopusSearch storing its results in the fixture archive."""
+
+    def __init__(self, query, refresh=False, integrity_fields=None, **kwds):
+        s = _LiveSearch(query, refresh=refresh,
+                        integrity_fields=integrity_fields, **kwds)
+        self.results = s.results
+        _archive.put_search(query, self.results)
+
+
+class ReplayScopusSearch:
+    """ScopusSearch stand-in serving results from the fixture archive."""
+
+    def __init__(self, query, refresh=False, integrity_fields=None,
+                 integrity_action="raise", **kwds):
+        simulate_request()
+        if re.fullmatch(r"EID\(.+?\)(?: OR EID\(.+?\))*", query):
+            eids = re.findall(r"EID\((.+?)\)", query)
+            fields, results = _archive.get_documents(eids)
+        else:
+            fields, results = _archive.get_search(query)
+        if results is None:
+            self.results = None
+            return
+        Document = namedtuple("Document", fields)
+        self.results = [Document(*r) for r in results]
+        if random() < CORRUPT_RATE and "coverDate" in fields:
+            self.results[0] = self.results[0]._replace(coverDate=None)
+        check_integrity(self.results, integrity_fields, integrity_action)
+
+
+class RecordingContentAffiliationRetrieval:
+    """ContentAffiliationRetrieval storing attributes in the fixture archive."""
+
+    def __init__(self, aff_id, refresh=False, **kwds):
+        try:
+            aff = _LiveRetrieval(aff_id, refresh=refresh, **kwds)
+        except exception.ScopusException as err:
+            _archive.put_affiliation(aff_id, {"error": type(err).__name__})
+            raise
+        data = {attr: getattr(aff, attr) for attr in AFF_ATTRIBUTES}
+        _archive.put_affiliation(aff_id, data)
+        self.__dict__.update(data)
+
+
+class ReplayContentAffiliationRetrieval:
+    """ContentAffiliationRetrieval stand-in serving attributes from the
+    fixture archive.
+    """
+
+    def __init__(self, aff_id, refresh=False, **kwds):
+        simulate_request()
+        data = _archive.get_affiliation(aff_id)
+        if "error" in data:
+            raise getattr(exception, data["error"])(aff_id)
+        self.__dict__.update(data)
+
+
+if BACKEND == "record":
+    ScopusSearch = RecordingScopusSearch
+    ContentAffiliationRetrieval = RecordingContentAffiliationRetrieval
+elif BACKEND == "replay":
+    ScopusSearch = ReplayScopusSearch
+    ContentAffiliationRetrieval = ReplayContentAffiliationRetrieval
+elif BACKEND == "live":
+    ScopusSearch = _LiveSearch
+    ContentAffiliationRetrieval = _LiveRetrieval
+else:
+    raise ValueError(f"Unknown Scopus backend {BACKEND}")
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+# Author:   Michael E. Rose <michael.ernst.rose@gmail.com>
+"""Provides access to the source files shared by all scripts reading them:
+listing and reading source files with their flags in CSV or Parquet
+format, the author index and the in-memory store of an analysis session.
+"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from hashlib import sha1
+from os import stat
+from os.path import basename, exists, getsize, splitext
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+    from pyarrow import parquet as pq
+except ImportError:
+    pa = None
+
+SOURCE_FOLDER = "./100_source_articles/"
+DATASET_FOLDER = "./100_source_dataset/"
+FLAGS_FOLDER = "./101_article_flags/"
+INDEX_FOLDER = "./102_author_index/"
+
+LOAD_THREADS = 8  # Number of source files read concurrently
+SOURCE_COLUMNS = ["eid", "source_id", "author", "author_count", "affiliations",
+                  "countries", "types"]
+FLAG_COLUMNS = ("multiaff", "foreignaff", "country", "combination")
+SOURCE_DTYPES = {"author": "uint64", "source_id": "uint64",
+                 "countries": "category", "types": "category",
+                 "multiaff": "uint8", "foreignaff": "uint8",
+                 "country": "category", "combination": "category"}
+TEXT_COLUMNS = ("eid", "affiliations", "countries", "types", "country",
+                "combination")
+
+
+def print_progress(iteration, total, length=50):
+    """Print terminal progress bar."""
+    share = iteration / float(total)
+    filled_len = int(length * iteration // total)
+    bar = "█" * filled_len + "-" * (length - filled_len)
+    print(f"\rProgress: |{bar}| {share:.2%} complete", end="\r")
+    if iteration == total:
+        print()
+
+
+def file_digest(fname):
+    """Content hash of a file."""
+    h = sha1()
+    with open(fname, "rb") as inf:
+        for block in iter(lambda: inf.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def source_stamp(fname):
+    """Size, modification time and content hash of CSV source file `fname`,
+    stored in the metadata of its Parquet copy.
+    """
+    info = stat(fname)
+    return {"size": info.st_size, "mtime": info.st_mtime_ns,
+            "digest": file_digest(fname)}
+
+
+def is_mirror(parts, fnames):
+    """Whether Parquet files `parts` mirror CSV source files `fnames`, i.e.
+    hold the same chunks and were written from CSV files with the current
+    content.  Content hashes are compared where size or modification time
+    differ from the stamp in the metadata of a part.
+    """
+    if pa is None:
+        return False
+    csvs = {splitext(f)[0].rsplit("_", 1)[1]: f for f in fnames}
+    parts = {splitext(basename(f))[0].split("-")[1]: f for f in parts}
+    if parts.keys() != csvs.keys():
+        return False
+    for chunk, fname in csvs.items():
+        meta = pq.read_schema(parts[chunk]).metadata or {}
+        if b"source" not in meta:
+            return False
+        stamp = json.loads(meta[b"source"])
+        info = stat(fname)
+        current = (info.st_size, info.st_mtime_ns)
+        if current != (stamp["size"], stamp["mtime"]) and \
+                file_digest(fname) != stamp["digest"]:
+            return False
+    return True
+
+
+def source_files(fields=None, years=None):
+    """List source files of `fields` and `years` (all if None) as tuples
+    (file name, field, year), using the Parquet dataset where it mirrors
+    the CSV files.
+    """
+    def selected(value, values):
+        return values is None or value in set(values)
+
+    files = {}
+    for f in sorted(glob(SOURCE_FOLDER + "articles_*.csv")):
+        field, year = splitext(basename(f))[0].split("_")[1].split("-")
+        field, year = int(field), int(year)
+        if selected(field, fields) and selected(year, years):
+            files.setdefault((field, year), []).append(f)
+    # Partitions replace CSV files of the same field-year unless outdated
+    parts = {}
+    for f in sorted(glob(DATASET_FOLDER + "field=*/year=*/*.parquet")):
+        field, year = [int(p.split("=")[1]) for p in f.split("/")[-3:-1]]
+        if selected(field, fields) and selected(year, years):
+            parts.setdefault((field, year), []).append(f)
+    for key, names in parts.items():
+        if key not in files or is_mirror(names, files[key]):
+            files[key] = names
+    return [(f, field, year) for (field, year), names in sorted(files.items())
+            for f in names]
+
+
+def read_table(fname, cols, dtype):
+    """Read columns `cols` of a CSV or Parquet file, parsing columns of
+    `dtype` read from CSV as categories or as 64-bit numbers, such that
+    values too wide for `dtype` do not fail parsing.
+    """
+    if fname.endswith(".parquet"):
+        return pd.read_parquet(fname, columns=cols)
+    dtype = {c: t if t == "category" else np.dtype(np.dtype(t).kind + "8")
+             for c, t in dtype.items()}
+    if pa is not None:
+        types = {c: pa.string() for c in TEXT_COLUMNS}
+        for c, t in dtype.items():
+            if t == "category":
+                types[c] = pa.dictionary(pa.int32(), pa.string())
+            else:
+                types[c] = pa.from_numpy_dtype(t)
+        options = pa_csv.ConvertOptions(include_columns=cols, column_types=types,
+                                        strings_can_be_null=True)
+        return pa_csv.read_csv(fname, convert_options=options).to_pandas()
+    text = {c: str for c in TEXT_COLUMNS if c in cols}
+    return pd.read_csv(fname, usecols=cols, encoding="utf8",
+                       dtype={**text, **dtype})
+
+
+def flags_file(fname):
+    """Name of the file in FLAGS_FOLDER with the flags of source file
+    `fname`, in Parquet format if pyarrow is installed.
+    """
+    stem = splitext(basename(fname))[0]
+    if fname.endswith(".parquet"):
+        field, year = [p.split("=")[1] for p in fname.split("/")[-3:-1]]
+        key = f"{field}-{year}_{stem.split('-')[1]}"
+    else:
+        key = stem.split("_", 1)[1]
+    ext = "parquet" if pa is not None else "csv"
+    return f"{FLAGS_FOLDER}flags_{key}.{ext}"
+
+
+def read_source_file(fname, cols, dtype=None):
+    """Read columns `cols` of one source file in CSV or Parquet format,
+    optionally casting them to `dtype`.  Columns in FLAG_COLUMNS are read
+    from the corresponding flags file.
+    """
+    dtype = dtype or {}
+    if _store is not None and fname in _store.bounds:
+        return _store.read(fname, cols, dtype)
+    flags = [c for c in FLAG_COLUMNS if c in cols]
+    cols = [c for c in SOURCE_COLUMNS if c in cols]
+    df = read_table(fname, cols, dtype) if cols else None
+    if flags:
+        new = read_table(flags_file(fname), flags, dtype)
+        if df is None:
+            df = new
+        elif df.shape[0] != new.shape[0]:
+            raise ValueError(f"Flags of {fname} are outdated, "
+                             "run _101_enrich_articles.py")
+        else:
+            df = pd.concat([df, new], axis=1)
+    return cast(df, dtype)
+
+
+def index_file(field, year):
+    """Name of the file in INDEX_FOLDER with the authors of a field-year."""
+    return f"{INDEX_FOLDER}authors_{field}-{year}.npz"
+
+
+def source_versions(fnames):
+    """Names, sizes and modification times, and content hashes of source
+    files `fnames` and their flags, to be stored with what is built from
+    them.
+    """
+    names = sorted(fnames + [flags_file(f) for f in fnames])
+    stats = [(stat(f).st_size, stat(f).st_mtime_ns) for f in names]
+    return {"sources": np.array(names), "source_stats": np.array(stats),
+            "source_digests": np.array([file_digest(f) for f in names])}
+
+
+def is_outdated(target, fnames):
+    """Whether `target` is missing or was built from other versions of
+    source files `fnames` or their flags than the current ones.
+
+    As in run_pipeline.py, a file changed only if its content did: content
+    hashes are compared where size or modification time differ.
+    """
+    if not exists(target):
+        return True
+    with np.load(target) as data:
+        if "sources" not in data.files:
+            return True
+        names, stats, digests = (data["sources"], data["source_stats"],
+                                 data["source_digests"])
+    if names.tolist() != sorted(fnames + [flags_file(f) for f in fnames]):
+        return True
+    for fname, (size, mtime), digest in zip(names, stats, digests):
+        info = stat(fname)
+        if (info.st_size, info.st_mtime_ns) == (size, mtime):
+            continue
+        if file_digest(fname) != digest:
+            return True
+    return False
+
+
+def cast(df, dtype):
+    """Cast columns to `dtype` and other categorical columns to strings."""
+    for c in df.columns:
+        if c in dtype:
+            df[c] = df[c].astype(dtype[c])
+        elif isinstance(df[c].dtype, pd.CategoricalDtype):
+            df[c] = df[c].astype(object)
+    return df
+
+
+def combine(frames, fields, years):
+    """Concatenate `frames` into preallocated columns, releasing the
+    columns of `frames` once copied, and add field and year.
+    """
+    if not frames:
+        raise ValueError("No source files to read")
+    sizes = [f.shape[0] for f in frames]
+    bounds = np.cumsum([0] + sizes)
+    out = {}
+    for c in frames[0].columns:
+        dtypes = [f[c].dtype for f in frames]
+        if all(isinstance(d, pd.CategoricalDtype) for d in dtypes):
+            out[c] = union_categoricals([f[c] for f in frames],
+                                        sort_categories=True)
+        elif all(isinstance(d, np.dtype) for d in dtypes):
+            out[c] = np.empty(bounds[-1], dtype=np.result_type(*dtypes))
+            for f, start, end in zip(frames, bounds[:-1], bounds[1:]):
+                out[c][start:end] = f[c].to_numpy()
+        else:
+            out[c] = pd.concat([f[c] for f in frames], ignore_index=True)
+        for f in frames:
+            del f[c]
+    out["field"] = np.repeat(np.array(fields, dtype="uint8"), sizes)
+    out["year"] = np.repeat(np.array(years, dtype="uint16"), sizes)
+    return pd.DataFrame(out)
+
+
+def load_files(files, cols, drop_duplicates=None, dtype=None):
+    """Read `files` in parallel and combine them, returning the data and
+    the number of rows read from each file.
+    """
+    def read(fname):
+        new = read_source_file(fname, cols, dtype)
+        if drop_duplicates:
+            new = new.drop_duplicates(subset=drop_duplicates)
+        return new
+
+    total = len(files)
+    print(f">>> Reading {total:,} files...")
+    start = perf_counter()
+    df = []
+    print_progress(0, total)
+    with ThreadPoolExecutor(LOAD_THREADS) as executor:
+        for idx, new in enumerate(executor.map(read, [f for f, _, _ in files])):
+            df.append(new)
+            print_progress(idx+1, total)
+    sizes = [new.shape[0] for new in df]
+    df = combine(df, [f for _, f, _ in files], [y for _, _, y in files])
+    elapsed = perf_counter() - start
+    size = sum(getsize(f) for f, _, _ in files)/1e6
+    print(f">>> Read {df.shape[0]:,} rows ({size:,.1f} MB) in {elapsed:.1f}s: "
+          f"{df.shape[0]/elapsed:,.0f} rows/s, {size/elapsed:,.1f} MB/s")
+    return df, sizes
+
+
+def read_source_files(cols, drop_duplicates=None, fields=None, years=None,
+                      dtype=None):
+    """Read files of `fields` and `years` from SOURCE_FOLDER or
+    DATASET_FOLDER in parallel with compact dtypes, or take them from the
+    store of the running analysis session.
+    """
+    dtype = {c: t for c, t in {**SOURCE_DTYPES, **(dtype or {})}.items()
+             if c in cols}
+    files = source_files(fields, years)
+    if _store is not None:
+        return _store.select(files, cols, drop_duplicates, dtype)
+    return load_files(files, cols, drop_duplicates, dtype)[0]
+
+
+class AuthorIndex:
+    """Sorted unique IDs of authors by field, year and country of first
+    affiliation, as written by _102_index_authors.py.
+
+    Exact unique counts over unions and intersections are array operations,
+    e.g. authors in both fields 27 and 28 in 2010-2015:
+    np.intersect1d(index.authors([27], range(2010, 2016)),
+                   index.authors([28], range(2010, 2016))).size
+    """
+
+    def __init__(self):
+        files = {}
+        for fname, field, year in source_files():
+            files.setdefault((field, year), []).append(fname)
+        for (field, year), fnames in files.items():
+            if is_outdated(index_file(field, year), fnames):
+                raise ValueError(f"Author index of {field}-{year} is outdated, "
+                                 "run _102_index_authors.py")
+        self.keys = sorted(files)
+        self._ids = {}
+
+    def load(self, field, year):
+        """Return author IDs of a field-year by country, with authors
+        without country under "".
+        """
+        key = (field, year)
+        if key not in self._ids:
+            with np.load(index_file(field, year)) as data:
+                countries, sizes, deltas = (data["countries"], data["sizes"],
+                                            data["deltas"])
+            bounds = np.cumsum(np.r_[0, sizes])
+            self._ids[key] = {c: np.cumsum(deltas[start:end])
+                              for c, start, end
+                              in zip(countries, bounds[:-1], bounds[1:])}
+        return self._ids[key]
+
+    def authors(self, fields=None, years=None, countries=None):
+        """Return sorted unique IDs of authors in `fields` and `years` with
+        first affiliation in `countries` (all if None).
+        """
+        parts = []
+        for field, year in self.keys:
+            if fields is not None and field not in fields or \
+                    years is not None and year not in years:
+                continue
+            parts.extend(ids for c, ids in self.load(field, year).items()
+                         if countries is None or c in countries)
+        if not parts:
+            return np.array([], dtype="uint64")
+        return np.unique(np.concatenate(parts))
+
+
+class SourceStore:
+    """All columns of all source files held in memory with compact dtypes,
+    the rows of each file kept contiguous.
+    """
+
+    columns = SOURCE_COLUMNS + list(FLAG_COLUMNS)
+
+    def __init__(self):
+        files = source_files()
+        dtype = {c: t for c, t in SOURCE_DTYPES.items() if c in self.columns}
+        self.df, sizes = load_files(files, self.columns, dtype=dtype)
+        bounds = np.cumsum([0] + sizes)
+        self.bounds = {f: (start, end) for (f, _, _), start, end
+                       in zip(files, bounds[:-1], bounds[1:])}
+
+    def read(self, fname, cols, dtype):
+        """Return columns `cols` of the rows of one file."""
+        start, end = self.bounds[fname]
+        cols = [c for c in self.columns if c in cols]
+        return cast(self.df.iloc[start:end][cols].reset_index(drop=True), dtype)
+
+    def select(self, files, cols, drop_duplicates, dtype):
+        """Return columns `cols` of the rows of `files` with field and
+        year, optionally without duplicates within each file.
+        """
+        cols = [c for c in self.columns if c in cols] + ["field", "year"]
+        parts = []
+        for fname, _, _ in files:
+            start, end = self.bounds[fname]
+            part = self.df.iloc[start:end]
+            if drop_duplicates:
+                part = part.drop_duplicates(subset=drop_duplicates)
+            parts.append(part[cols])
+        if not parts:
+            raise ValueError("No source files to read")
+        return cast(pd.concat(parts, ignore_index=True), dtype)
+
+
+_store = None
+
+
+def run_session(scripts, times_file=None):
+    """Load all source files once and run the main functions of `scripts`
+    one after another, reading from memory instead of from disk.
+
+    The wall time of each finished script is written to JSON file
+    `times_file` if given.
+    """
+    from importlib import import_module
+    global _store
+    _store = SourceStore()
+    times = {}
+    for script in scripts:
+        print(f">>> Running {script} in session...")
+        start = perf_counter()
+        import_module(script).main()
+        times[script] = perf_counter() - start
+        print(f">>> {script} finished after {times[script]:.1f}s")
+        if times_file:
+            with open(times_file, "w") as ouf:
+                json.dump(times, ouf)
+    _store = None